@@ -12,12 +12,19 @@ handle multiple API keys!
 # pylint: disable=dangerous-default-value
 
 import base64
+import contextlib
+import email.utils
 import json
+import os
+import random
 import re
 import secrets
+import threading
+import time
 import traceback
 
 import requests
+import requests.adapters
 
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
@@ -30,6 +37,10 @@ from config import settings
 
 NAME = "bunq2IFTTT"
 
+# The configuration is read by almost every request, so keep it in memory
+storage.enable_cache("bunq2IFTTT")
+storage.enable_compression("bunq2IFTTT")
+
 
 # Core request methods
 #----------------------
@@ -126,8 +137,7 @@ def install_key(config):
 
     config["install_token"] = install_token
     config["server_key_enc"] = srv_key
-    config["server_key"] = serialization.load_pem_public_key(
-        srv_key.encode("ascii"), backend=default_backend())
+    config["server_key"] = load_key(srv_key, False)
 
 
 def register_token(config, name, allips):
@@ -253,6 +263,16 @@ def save_config(config):
             tosave[key] = config[key]
     storage.store_large("bunq2IFTTT", "bunq_config", tosave)
 
+def update_config(change):
+    """ Change the stored configuration parameters without overwriting
+        concurrent changes, change is called with the stored parameters and
+        modifies them in place """
+    def change_value(tosave):
+        tosave = tosave if tosave is not None else {}
+        change(tosave)
+        return tosave
+    storage.update("bunq2IFTTT", "bunq_config", change_value, large=True)
+
 def retrieve_config(config={}):
     """ Retrieve the configuration parameters from storage """
     for key in list(config.keys()):
@@ -263,19 +283,34 @@ def retrieve_config(config={}):
             config[key] = toload[key]
     # Convert strings back to keys
     if "server_key_enc" in config:
-        config["server_key"] = serialization.load_pem_public_key(
-            config["server_key_enc"].encode("ascii"),
-            backend=default_backend())
+        config["server_key"] = load_key(config["server_key_enc"], False)
     if "public_key_enc" in config:
-        config["public_key"] = serialization.load_pem_public_key(
-            config["public_key_enc"].encode("ascii"),
-            backend=default_backend())
+        config["public_key"] = load_key(config["public_key_enc"], False)
     if "private_key_enc" in config:
-        config["private_key"] = serialization.load_pem_private_key(
-            config["private_key_enc"].encode("ascii"),
-            password=None, backend=default_backend())
+        config["private_key"] = load_key(config["private_key_enc"], True)
     return config
 
+# Parsing a PEM key, especially a private one, takes milliseconds, and the
+# keys hardly ever change. Parsed keys are kept by their PEM text, so a
+# changed key is simply parsed again.
+KEY_CACHE = {}
+KEY_CACHE_MAXSIZE = 8
+
+def load_key(pem, private):
+    """ Return the key object for a PEM encoded public or private key """
+    key = KEY_CACHE.get(pem)
+    if key is None:
+        if private:
+            key = serialization.load_pem_private_key(
+                pem.encode("ascii"), password=None, backend=default_backend())
+        else:
+            key = serialization.load_pem_public_key(
+                pem.encode("ascii"), backend=default_backend())
+        if len(KEY_CACHE) >= KEY_CACHE_MAXSIZE:
+            KEY_CACHE.clear()
+        KEY_CACHE[pem] = key
+    return key
+
 
 def get_session_token(config):
     """ Return the session token, create or retrieve from storage if needed """
@@ -319,30 +354,133 @@ def get_public_key(config):
 # Deal with session key expiration
 #----------------------------------
 
+# The session token is refreshed in the background when its known expiry
+# gets near, so requests don't have to fail first. Only one refresh runs at
+# a time: other requests in this process wait for it, and other instances
+# see the lease in storage and wait for the new token to be stored. bunq
+# extends a session with every request, so the expiry used here, counted
+# from its creation, is on the safe side.
+SESSION_TIMEOUT_DEFAULT = 3600
+SESSION_REFRESH_MARGIN = 300
+SESSION_LEASE = 30
+SESSION_LOCK = threading.Lock()
+SESSION_THREAD = None
+SESSION_THREAD_LOCK = threading.Lock()
+SESSION_ERRORS = ["Insufficient authorisation.",
+                  "Insufficient authentication."]
+SESSION_ENDPOINTS = ["v1/installation", "v1/device-server",
+                     "v1/session-server"]
+
 def session_request(method, endpoint, config, data=None, extra_headers=None):
     """ Send a request, refreshing session keys if needed """
+    if endpoint in SESSION_ENDPOINTS:
+        return request(method, endpoint, config, data, extra_headers)
+    token = get_session_token(config)
+    expiry = config.get("session_expiry")
+    if expiry is not None and time.time() > expiry:
+        token = refresh_session_token(config, token)
+    elif expiry is not None and time.time() > expiry - SESSION_REFRESH_MARGIN:
+        refresh_session_background(config)
     result = request(method, endpoint, config, data, extra_headers)
     if isinstance(result, dict) and "Error" in result and \
-            result["Error"][0]["error_description"] in \
-            ["Insufficient authorisation.", "Insufficient authentication."]:
-        refresh_session_token(config)
+            result["Error"][0]["error_description"] in SESSION_ERRORS:
+        refresh_session_token(config, token)
         result = request(method, endpoint, config, data, extra_headers)
     return result
 
-def refresh_session_token(config):
-    """ Refresh an expired session token """
+def refresh_session_background(config):
+    """ Refresh the session token in a background thread, unless that is
+        being done already """
+    global SESSION_THREAD
+    with SESSION_THREAD_LOCK:
+        if SESSION_THREAD is not None and SESSION_THREAD.is_alive():
+            return
+        SESSION_THREAD = threading.Thread(
+            target=refresh_session_token,
+            args=(config, config.get("session_token")), daemon=True)
+        SESSION_THREAD.start()
+
+def refresh_session_token(config, token=None):
+    """ Refresh an expired session token, unless another request or instance
+        replaced it already. token is the expired session token. """
+    with SESSION_LOCK:
+        deadline = time.time() + SESSION_LEASE
+        owner = secrets.token_hex(8)
+        while True:
+            stored = session_stored(config)
+            if stored is not None and stored["session_token"] != token:
+                print("[bunq] Using session token refreshed elsewhere")
+                config["session_token"] = stored["session_token"]
+                config["session_expiry"] = stored.get("session_expiry")
+                return stored["session_token"]
+            if session_lease(owner, time.time() + SESSION_LEASE) \
+                    or time.time() > deadline:
+                break
+            time.sleep(0.5)
+        try:
+            return session_create(config)
+        finally:
+            session_lease(owner, 0)
+
+def session_stored(config):
+    """ Helper method to return the stored session token and expiry, if they
+        belong to the same installation as config """
+    stored, _ = storage.retrieve_versioned("bunq2IFTTT", "bunq_config")
+    if stored is None:
+        return None
+    stored = stored["value"]
+    if "session_token" not in stored or \
+            stored.get("install_token") != config.get("install_token"):
+        return None
+    return stored
+
+def session_lease(owner, until):
+    """ Helper method to claim (or with until 0 release) the lease on
+        refreshing the session token, returns whether it is held by owner """
+    def change(lease):
+        if lease is not None and lease["owner"] != owner and \
+                lease["until"] > time.time():
+            return None
+        if lease is None and not until:
+            return None
+        return {"owner": owner, "until": until}
+    return storage.update("bunq2IFTTT", "session_lease", change) is not None
+
+def session_create(config):
+    """ Helper method to create a new session and store its token """
     print("[bunq] Refreshing session token...")
     data = {"secret": get_access_token(config)}
-    result = post("v1/session-server", data, config)
+    created = time.time()
+    result = request("POST", "v1/session-server", config, data)
     if "Response" in result:
         session_token = result["Response"][1]["Token"]["token"]
+        timeout = session_timeout(result["Response"][2])
+        session_expiry = created + (timeout or SESSION_TIMEOUT_DEFAULT)
         config["session_token"] = session_token
-        save_config(config)
+        config["session_expiry"] = session_expiry
+        def change(tosave):
+            tosave["session_token"] = session_token
+            tosave["session_expiry"] = session_expiry
+        update_config(change)
         return session_token
     print("ERROR: session token refresh failed!")
     print(result)
     return ""
 
+def session_timeout(data):
+    """ Helper method to find the session timeout of the user in the reply
+        of a session-server call """
+    if isinstance(data, dict):
+        if isinstance(data.get("session_timeout"), int):
+            return data["session_timeout"]
+        data = list(data.values())
+    if isinstance(data, list):
+        for item in data:
+            timeout = session_timeout(item)
+            if timeout:
+                return timeout
+    return None
+
 def session_request_encrypted(method, endpoint, data, config={}):
     """ Send an encrypted request to the bunq API """
     data = json.dumps(data).encode("utf-8")
@@ -375,6 +513,21 @@ def session_request_encrypted(method, endpoint, data, config={}):
 
 BUNQAPI = "https://api.bunq.com/"
 
+# All requests share one session, so connections to bunq are kept alive and
+# reused instead of doing a TCP and TLS handshake for every call. Requests
+# that fail with a connection error, a timeout, or a 5xx status are retried
+# with exponential backoff if they are idempotent, rate limited (429)
+# requests always, waiting for Retry-After when bunq sends it. A POST is
+# only retried when it didn't reach bunq (429 or connect timeout).
+TIMEOUT = (5, 30) # connect, read
+RETRIES = 3
+RETRY_STATUS = [429, 500, 502, 503, 504]
+RETRY_AFTER_MAX = 10
+IDEMPOTENT = ["GET", "PUT", "DELETE"]
+HTTP = requests.Session()
+HTTP.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2,
+                                                    pool_maxsize=16))
+
 def request(method, endpoint, config, data=None, extra_headers=None):
     """ This method executes the actual request to the bunq API """
     print(method, endpoint)
@@ -394,16 +547,11 @@ def request(method, endpoint, config, data=None, extra_headers=None):
     elif endpoint != "v1/installation":
         headers['X-Bunq-Client-Authentication'] = get_session_token(config)
     sign(endpoint, config, headers, data)
-    if method == "GET":
-        reply = requests.get(BUNQAPI + endpoint, headers=headers)
-    elif method == "POST":
-        reply = requests.post(BUNQAPI + endpoint, headers=headers, data=data)
-    elif method == "PUT":
-        reply = requests.put(BUNQAPI + endpoint, headers=headers, data=data)
-    elif method == "DELETE":
-        reply = requests.delete(BUNQAPI + endpoint, headers=headers)
-    if reply.status_code == 500 and re.match(r"v1/user/\d+/card/\d+",
-                                             endpoint):
+    card = re.match(r"v1/user/\d+/card/\d+", endpoint)
+    reply = send(method, BUNQAPI + endpoint, headers,
+                 data if method in ["POST", "PUT"] else None,
+                 retry_errors=not card)
+    if reply.status_code == 500 and card:
         print("Ignoring error 500 for card update")
         return "OK" # work around a bug where the bunq API returns status 500
                     # on a card account update, even though the call succeeded
@@ -412,6 +560,54 @@ def request(method, endpoint, config, data=None, extra_headers=None):
         return reply.json()
     return reply.text
 
+def send(method, url, headers, data, retry_errors=True):
+    """ Send a request over the shared session, retrying transient failures.
+        With retry_errors=False only rate limited requests are retried. """
+    for attempt in range(RETRIES + 1):
+        rate_wait(method, url)
+        try:
+            reply = HTTP.request(method, url, headers=headers, data=data,
+                                 timeout=TIMEOUT)
+        except requests.ConnectTimeout:
+            if attempt == RETRIES:
+                raise
+            delay = None
+        except (requests.ConnectionError, requests.Timeout):
+            if method not in IDEMPOTENT or attempt == RETRIES:
+                raise
+            delay = None
+        else:
+            if reply.status_code not in RETRY_STATUS or attempt == RETRIES:
+                return reply
+            if reply.status_code != 429 and \
+                    (method not in IDEMPOTENT or not retry_errors):
+                return reply
+            if reply.status_code == 429:
+                rate_exhausted(method, url)
+            delay = retry_after(reply)
+        if delay is None:
+            delay = random.uniform(0.5, 1) * 2 ** attempt
+        print("[bunq] {} {} failed, retrying in {:.1f}s".format(
+            method, url, delay))
+        time.sleep(delay)
+    return reply
+
+def retry_after(reply):
+    """ Return the number of seconds to wait according to the Retry-After
+        header of a reply, or None """
+    value = reply.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = email.utils.parsedate_to_datetime(value).timestamp() \
+                - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0), RETRY_AFTER_MAX)
+
 def sign(endpoint, config, headers, data):
     """ Sign the message before sending """
     if endpoint == "v1/installation":
@@ -450,3 +646,123 @@ def verify(endpoint, config, status_code, headers, text):
                        padding.PKCS1v15(), hashes.SHA256())
         except InvalidSignature:
             print("WARNING: signature verification failed!")
+
+
+# Rate limiting
+#---------------
+
+# bunq allows a few calls per method per endpoint in any three seconds.
+# Calls are paced with a token bucket per method and endpoint class (the
+# endpoint with its ids left out), so a burst of actions is spread out
+# instead of failing with 429. Callers wait at most RATE_WAIT_MAX seconds
+# and are then sent anyway, relying on the retries for 429. Calls made
+# within low_priority(), like refreshing option lists, wait until no other
+# calls are waiting for the same bucket. The limits are per process.
+RATE_LIMIT = os.getenv("BUNQ2IFTTT_RATE_LIMIT", "1") == "1"
+RATE_LIMITS = { # method: (calls, seconds)
+    "GET": (3, 3),
+    "POST": (5, 3),
+    "PUT": (2, 3),
+    "DELETE": (2, 3),
+}
+RATE_LIMITS_ENDPOINT = {
+    "v1/session-server": (1, 30),
+}
+RATE_WAIT_MAX = float(os.getenv("BUNQ2IFTTT_RATE_WAIT_MAX", "10"))
+RATE_LOCK = threading.Condition()
+RATE_BUCKETS = {}
+RATE_STATS = {}
+RATE_PRIORITY = threading.local()
+
+@contextlib.contextmanager
+def low_priority():
+    """ Let the enclosed calls to bunq wait for all other calls """
+    previous = getattr(RATE_PRIORITY, "low", False)
+    RATE_PRIORITY.low = True
+    try:
+        yield
+    finally:
+        RATE_PRIORITY.low = previous
+
+def rate_key(method, url):
+    """ Helper method to return the bucket of a call """
+    endpoint = url[len(BUNQAPI):] if url.startswith(BUNQAPI) else url
+    endpoint = re.sub(r"/\d+", "/*", endpoint.split("?")[0])
+    return method + " " + endpoint
+
+def rate_bucket(method, url):
+    """ Helper method to return the refilled bucket of a call, must be
+        called with RATE_LOCK held """
+    key = rate_key(method, url)
+    if key not in RATE_BUCKETS:
+        endpoint = key.split(" ", 1)[1]
+        calls, seconds = RATE_LIMITS_ENDPOINT.get(
+            endpoint, RATE_LIMITS.get(method, RATE_LIMITS["GET"]))
+        RATE_BUCKETS[key] = {"tokens": calls, "burst": calls,
+                             "rate": calls / seconds, "time": time.time(),
+                             "waiting": 0}
+    bucket = RATE_BUCKETS[key]
+    now = time.time()
+    bucket["tokens"] = min(bucket["burst"], bucket["tokens"] +
+                           (now - bucket["time"]) * bucket["rate"])
+    bucket["time"] = now
+    return key, bucket
+
+def rate_wait(method, url):
+    """ Wait until a call may be sent without exceeding the rate limit """
+    if not RATE_LIMIT:
+        return
+    low = getattr(RATE_PRIORITY, "low", False)
+    start = time.time()
+    with RATE_LOCK:
+        key, bucket = rate_bucket(method, url)
+        if not low:
+            bucket["waiting"] += 1
+        try:
+            while True:
+                if bucket["tokens"] >= 1 and (not low or
+                                              bucket["waiting"] == 0):
+                    break
+                left = start + RATE_WAIT_MAX - time.time()
+                if left <= 0:
+                    print("[bunq] rate limit wait exceeded for " + key)
+                    break
+                delay = (1 - bucket["tokens"]) / bucket["rate"]
+                RATE_LOCK.wait(min(max(delay, 0.01), left))
+                key, bucket = rate_bucket(method, url)
+            bucket["tokens"] -= 1
+        finally:
+            if not low:
+                bucket["waiting"] -= 1
+            RATE_LOCK.notify_all()
+        waited = time.time() - start
+        stats = rate_record(key)
+        stats["calls"] += 1
+        if waited >= 0.001:
+            stats["waits"] += 1
+            stats["wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+
+def rate_exhausted(method, url):
+    """ Empty the bucket of a call that bunq rejected with 429 """
+    if not RATE_LIMIT:
+        return
+    with RATE_LOCK:
+        key, bucket = rate_bucket(method, url)
+        bucket["tokens"] = min(bucket["tokens"], 0)
+        rate_record(key)["throttled"] += 1
+
+def rate_record(key):
+    """ Helper method to return the statistics of a bucket, must be called
+        with RATE_LOCK held """
+    if key not in RATE_STATS:
+        RATE_STATS[key] = {"calls": 0, "waits": 0, "wait_seconds": 0.0,
+                           "max_wait_seconds": 0.0, "throttled": 0}
+    return RATE_STATS[key]
+
+def rate_stats():
+    """ Return per bucket the number of calls, how many had to wait and for
+        how long in total and at most, and how many bunq rejected (429) """
+    with RATE_LOCK:
+        return json.loads(json.dumps({"enabled": RATE_LIMIT,
+                                      "stats": RATE_STATS}))
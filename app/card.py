@@ -16,7 +16,8 @@ import bunq
 def get_bunq_cards():
     """ Return the list of bunq cards """
     config = bunq.retrieve_config()
-    data = bunq.get("v1/user/{}/card".format(config["user_id"]), config)
+    with bunq.low_priority():
+        data = bunq.get("v1/user/{}/card".format(config["user_id"]), config)
     results = []
     for item in data["Response"]:
         for typ in item:
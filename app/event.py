@@ -20,6 +20,25 @@ from flask import request
 import storage
 import util
 
+# Kinds of the trigger records
+TRIGGER_KINDS = ("trigger_mutation", "trigger_balance", "trigger_request",
+                 "trigger_newimage")
+# Kinds of the trigger histories, with the kind of their triggers
+TRIGGER_HISTORIES = [("trigger_mutation", "trigger_mutation"),
+                     ("trigger_balance", "trigger_balance"),
+                     ("trigger_request", "trigger_request"),
+                     ("trigger_newimagecb", "trigger_newimage")]
+for _kind in TRIGGER_KINDS:
+    # Trigger records are read on every IFTTT poll. Their histories, in the
+    # same kinds, are always read from storage (see get_latest_values).
+    storage.enable_cache(_kind)
+    # Triggers are only queried on the account
+    storage.enable_packing(_kind, ["account"])
+    # Histories hold full items with many repeated labels
+    storage.enable_compression(_kind)
+# The newimage histories have a kind of their own
+storage.enable_compression("trigger_newimagecb")
+
 
 ###############################################################################
 # Callback methods called by bunq
@@ -68,12 +87,15 @@ def bunq_callback_request():
         triggerids = []
         for account in ["ANY", iban]:
             for trigger in storage.query("trigger_request",
-                                         "account", "=", account):
+                                         "account", "=", account,
+                                         ["identity", "fields"]):
                 ident = trigger["identity"]
                 if check_fields("request", ident, item, trigger["fields"]):
                     triggerids.append(ident)
-                    storage.insert_value_maxsize("trigger_request",
-                                                 ident+"_t", item, 50)
+        with storage.batch(deferred=True):
+            storage.insert_value_maxsize_many(
+                "trigger_request", [ident+"_t" for ident in triggerids],
+                item, 50)
         print("[bunqcb_request] Matched triggers:", json.dumps(triggerids))
         if triggerids:
             data = {"data": []}
@@ -135,28 +157,40 @@ def bunq_callback_mutation():
 
         print("[bunqcb_mutation] translated: {}".format(json.dumps(item)))
         triggerids_1 = []
-        triggerids_2 = []
-        for account in ["ANY", iban]:
-            for trigger in storage.query("trigger_mutation",
-                                         "account", "=", account):
-                ident = trigger["identity"]
-                if check_fields("mutation", ident, item, trigger["fields"]):
-                    triggerids_1.append(ident)
-                    storage.insert_value_maxsize("trigger_mutation",
-                                                 ident+"_t", item, 50)
-            for trigger in storage.query("trigger_balance",
-                                         "account", "=", account):
-                ident = trigger["identity"]
-                if check_fields("balance", ident, item, trigger["fields"]):
-                    if not trigger["last"]:
-                        triggerids_2.append(ident)
-                        storage.insert_value_maxsize("trigger_balance",
-                                                     ident+"_t", item, 50)
-                        trigger["last"] = True
-                        storage.store("trigger_balance", ident, trigger)
-                elif trigger["last"]:
-                    trigger["last"] = False
-                    storage.store("trigger_balance", ident, trigger)
+        flips = {}
+        # the history inserts of this callback are done in a single batch,
+        # balance triggers are flipped immediately, all in one commit, so a
+        # concurrent callback for the same trigger can not notify IFTTT as
+        # well. In write-behind mode both go to the journal instead, as does
+        # the balance.
+        with storage.batch(deferred=True):
+            util.save_account_balance(
+                iban, float(payment["balance_after_mutation"]["value"]),
+                metaid)
+            for account in ["ANY", iban]:
+                for trigger in storage.query("trigger_mutation",
+                                             "account", "=", account,
+                                             ["identity", "fields"]):
+                    ident = trigger["identity"]
+                    if check_fields("mutation", ident, item,
+                                    trigger["fields"]):
+                        triggerids_1.append(ident)
+                for trigger in storage.query("trigger_balance",
+                                             "account", "=", account,
+                                             ["identity", "fields", "last"]):
+                    ident = trigger["identity"]
+                    last = bool(check_fields("balance", ident, item,
+                                             trigger["fields"]))
+                    if last != bool(trigger["last"]):
+                        flips[ident] = last
+            triggerids_2 = [ident for ident in set_balance_last(flips)
+                            if flips[ident]]
+            storage.insert_value_maxsize_many(
+                "trigger_mutation", [ident+"_t" for ident in triggerids_1],
+                item, 50)
+            storage.insert_value_maxsize_many(
+                "trigger_balance", [ident+"_t" for ident in triggerids_2],
+                item, 50)
         print("Matched mutation triggers:", json.dumps(triggerids_1))
         print("Matched balance triggers:", json.dumps(triggerids_2))
         data = {"data": []}
@@ -216,12 +250,15 @@ def nuistics_callback_request():
         triggerids = []
         for account in ["ANY", acc]:
             for trigger in storage.query("trigger_newimage",
-                                         "account", "=", account):
+                                         "account", "=", account,
+                                         ["identity", "fields"]):
                 ident = trigger["identity"]
                 if check_fields("newimage", ident, item, trigger["fields"]):
                     triggerids.append(ident)
-                    storage.insert_value_maxsize("trigger_newimagecb",
-                                                 ident+"_t", item, 50)
+        with storage.batch(deferred=True):
+            storage.insert_value_maxsize_many(
+                "trigger_newimagecb", [ident+"_t" for ident in triggerids],
+                item, 50)
         print("[nuisticscb_request] Matched triggers:", json.dumps(triggerids))
         if triggerids:
             data = {"data": []}
@@ -250,6 +287,20 @@ def nuistics_callback_request():
 # Helper methods for bunq callbacks
 ###############################################################################
 
+def set_balance_last(flips):
+    """ Change the 'last' state of balance triggers, flips is a dict of the
+        new states by identity. Returns the identities that changed, i.e.
+        not those that already had the state (e.g. set by a concurrent
+        callback) """
+    def change(identity, trigger):
+        if trigger is None or bool(trigger["last"]) == flips[identity]:
+            return None
+        trigger["last"] = flips[identity]
+        return trigger
+    if not flips:
+        return []
+    return list(storage.update_many("trigger_balance", flips, change))
+
 def mutation_type(payment):
     """ Return the type of a payment """
     muttype = "TRANSFER_OTHER"
@@ -465,9 +516,8 @@ def trigger_mutation():
             print("[trigger_mutation] storing new trigger {} {}"
                   .format(account, fieldsstr))
 
-        transactions = storage.get_value("trigger_mutation", identity+"_t")
-        if transactions is None:
-            transactions = []
+        transactions = storage.get_latest_values("trigger_mutation",
+                                                 identity+"_t", limit)
         for trans in transactions:
             trans["created_at"] = arrow.get(trans["created_at"])\
                                   .to(timezone).isoformat()
@@ -539,9 +589,11 @@ def trigger_mutation_test(limit):
 def trigger_mutation_delete(identity):
     """ Delete a specific trigger identity for IFTTT trigger bunq_mutation """
     try:
-        for index in storage.query_indexes("mutation_"+identity):
-            storage.remove("mutation_"+identity, index)
-        storage.remove("trigger_mutation", identity)
+        with storage.batch():
+            for index in storage.query_indexes("mutation_"+identity):
+                storage.remove("mutation_"+identity, index)
+            storage.remove_cascade("trigger_mutation", identity,
+                                   [("trigger_mutation", identity+"_t")])
 
         return ""
     except Exception:
@@ -608,9 +660,8 @@ def trigger_balance():
             print("[trigger_balance] storing new trigger {} {}"
                   .format(account, fieldsstr))
 
-        transactions = storage.get_value("trigger_balance", identity+"_t")
-        if transactions is None:
-            transactions = []
+        transactions = storage.get_latest_values("trigger_balance",
+                                                 identity+"_t", limit)
         for trans in transactions:
             trans["created_at"] = arrow.get(trans["created_at"])\
                                   .to(timezone).isoformat()
@@ -661,9 +712,11 @@ def trigger_balance_test(limit):
 def trigger_balance_delete(identity):
     """ Delete a specific trigger identity for IFTTT trigger bunq_balance """
     try:
-        for index in storage.query_indexes("balance_"+identity):
-            storage.remove("balance_"+identity, index)
-        storage.remove("trigger_balance", identity)
+        with storage.batch():
+            for index in storage.query_indexes("balance_"+identity):
+                storage.remove("balance_"+identity, index)
+            storage.remove_cascade("trigger_balance", identity,
+                                   [("trigger_balance", identity+"_t")])
 
         return ""
     except Exception:
@@ -727,9 +780,8 @@ def trigger_request():
             print("[trigger_request] storing new trigger {} {}"
                   .format(account, fieldsstr))
 
-        transactions = storage.get_value("trigger_request", identity+"_t")
-        if transactions is None:
-            transactions = []
+        transactions = storage.get_latest_values("trigger_request",
+                                                 identity+"_t", limit)
         for trans in transactions:
             trans["created_at"] = arrow.get(trans["created_at"])\
                                   .to(timezone).isoformat()
@@ -792,9 +844,11 @@ def trigger_request_test(limit):
 def trigger_request_delete(identity):
     """ Delete a specific trigger identity for IFTTT trigger bunq_request """
     try:
-        for index in storage.query_indexes("request_"+identity):
-            storage.remove("request_"+identity, index)
-        storage.remove("trigger_request", identity)
+        with storage.batch():
+            for index in storage.query_indexes("request_"+identity):
+                storage.remove("request_"+identity, index)
+            storage.remove_cascade("trigger_request", identity,
+                                   [("trigger_request", identity+"_t")])
 
         return ""
     except Exception:
@@ -947,9 +1001,8 @@ def trigger_newimage():
             print("[trigger_newimage] storing new trigger {} {}"
                   .format(account, fieldsstr))
 
-        transactions = storage.get_value("trigger_newimagecb", identity+"_t")
-        if transactions is None:
-            transactions = []
+        transactions = storage.get_latest_values("trigger_newimagecb",
+                                                 identity+"_t", limit)
         for trans in transactions:
             trans["created_at"] = arrow.get(trans["created_at"])\
                                   .to(timezone).isoformat()
@@ -1000,10 +1053,8 @@ def trigger_newimage_test(limit):
 def trigger_newimage_delete(identity):
     """ Delete a specific trigger identity for IFTTT trigger nuistics_newimage """
     try:
-        # for index in storage.query_indexes("request_"+identity):
-        #     storage.remove("request_"+identity, index)
-        storage.remove("trigger_newimage", identity)
-        storage.remove("trigger_newimagecb", identity+"_t")
+        storage.remove_cascade("trigger_newimage", identity,
+                               [("trigger_newimagecb", identity+"_t")])
 
         return ""
     except Exception:
@@ -113,6 +113,24 @@ def update_accounts():
         'Account update completed<br><br>'\
         '<a href="/">Click here to return home</a>')
 
+@app.route("/repack", methods=["GET"])
+def repack():
+    """ Endpoint to rewrite records stored before they were packed, needed
+        only once after upgrading """
+    cookie = request.cookies.get('session')
+    if cookie is None or cookie != util.get_session_cookie():
+        return render_template("message.html", msgtype="danger", msg=\
+            "Invalid request: session cookie not set or not valid")
+    total = 0
+    for kind in storage.PACKED:
+        count = storage.repack(kind)
+        if count:
+            print("[repack] repacked {} {} records".format(count, kind))
+        total += count
+    return render_template("message.html", msgtype="success", msg=\
+        'Repacked {} records<br><br>'\
+        '<a href="/">Click here to return home</a>'.format(total))
+
 @app.route("/account_change_permission", methods=["GET"])
 def account_change_permission():
     """ Enable/disable a permissions for an account """
@@ -130,6 +148,21 @@ def account_change_permission():
         'Something went wrong, please check the logs!<br><br>'\
         '<a href="/">Click here to return home</a>')
 
+@app.route("/storage_stats", methods=["GET"])
+def storage_stats():
+    """ Endpoint with the storage profile and cache statistics, and the
+        bunq rate limiting statistics """
+    cookie = request.cookies.get('session')
+    if cookie is None or cookie != util.get_session_cookie():
+        return render_template("message.html", msgtype="danger", msg=\
+            "Invalid request: session cookie not set or not valid")
+    return json.dumps({
+        "profile": storage.profile_stats(),
+        "cache": storage.cache_stats(),
+        "seen": storage.seen_stats(),
+        "bunq_rate": bunq.rate_stats()
+    }), 200, {"Content-Type": "application/json"}
+
 
 ###############################################################################
 # Helper methods
@@ -157,23 +190,42 @@ def check_access_token():
 # Cron endpoints
 ###############################################################################
 
-@app.route("/cron/clean_seen")
-def clean_seen():
-    """ Clean the seen cache periodically """
+def check_cron_call():
+    """ Check that a cron endpoint is called by the cron service """
     if os.getenv("GAE_INSTANCE") is not None:
         if "X-Appengine-Cron" not in request.headers\
         or request.headers["X-Appengine-Cron"] != "true":
             print("Invalid cron call")
-            return "Invalid cron call"
+            return False
     else:
         host = request.host
         if host.find(":") > -1:
             host = host[:host.find(":")]
         if host not in ["127.0.0.1", "localhost"]:
-            return "Invalid cron call"
+            return False
+    return True
+
+@app.route("/cron/clean_seen")
+def clean_seen():
+    """ Clean the seen cache periodically """
+    if not check_cron_call():
+        return "Invalid cron call"
 
     storage.clean_seen("seen_mutation")
     storage.clean_seen("seen_request")
+    print("[cron] seen stats: {}".format(json.dumps(storage.seen_stats())))
+    return ""
+
+@app.route("/cron/sweep_histories")
+def sweep_histories():
+    """ Remove the histories of deleted triggers """
+    if not check_cron_call():
+        return "Invalid cron call"
+
+    for kind, owner_kind in event.TRIGGER_HISTORIES:
+        count = storage.remove_orphans(kind, owner_kind)
+        if count:
+            print("[cron] removed {} orphaned {} records".format(count, kind))
     return ""
 
 
@@ -146,5 +146,14 @@ def ifttt_bunq_payment(internal, draft):
             "message": result["Error"][0]["error_description"]
         }]}), 400
 
+    # the balances change before the callback of the payment arrives
+    if not draft:
+        ibans = [fields["source_account"]]
+        if internal:
+            ibans.append(fields["target_account"])
+        for iban in ibans:
+            util.forget_account_balance(iban,
+                                        result["Response"][0]["Id"]["id"])
+
     return json.dumps({"data": [{
         "id": str(result["Response"][0]["Id"]["id"])}]})
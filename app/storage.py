@@ -4,27 +4,184 @@ Abstraction layer for storage
 Depending on whether the application is run in appengine or standalone,
 it will select:
 - Google datastore storage
+- SQLite storage, when the environment variable BUNQ2IFTTT_STORAGE is set
+  to "sqlite" (the database file is db/storage.sqlite3, or the path in
+  BUNQ2IFTTT_SQLITE_PATH)
+- In-memory storage, when BUNQ2IFTTT_STORAGE is set to "memory" (optionally
+  saved to the file in BUNQ2IFTTT_MEMORY_SNAPSHOT every
+  BUNQ2IFTTT_MEMORY_SNAPSHOT_INTERVAL seconds and at exit), for a single
+  process only
 - Local storage in the db/ directory
+
+Records of kinds that opted in with enable_cache() are kept in a bounded
+in-process cache, which is invalidated by every write through this module.
+Writes can be grouped with 'with batch():' to write them in one round trip.
+
+Arrays stored with insert_value_maxsize (the trigger histories) are ring
+buffers: a head record with the number of inserted values, and one record
+per slot named <index>.<slot>. Inserting a value writes one slot and the
+head, and get_latest_values only reads the slots it returns. remove_cascade
+removes a record together with its arrays, remove_orphans sweeps up arrays
+whose record is gone.
+
+Large values of kinds that opted in with enable_compression() are stored
+zlib compressed.
+
+Every record carries a version number, so read-modify-write cycles can use
+store_if_version or update to detect concurrent writers and retry, instead
+of serializing all writers behind a lock.
+
+query_all and query return lists; iter_all, iter_query and query_page read
+the same results a page at a time, with a cursor to resume from.
+
+seen() answers repeated objects from an in-process set, so duplicate
+callbacks don't need a storage transaction.
+
+The local storage spreads the records of a kind over 256 shard directories,
+and maintains secondary indexes in db/_index/ for equality queries, so
+looking up e.g. the triggers of one account only touches the matching
+records instead of every record of the kind.
 """
 
+import atexit
+import base64
+import bisect
+import collections
+import contextlib
+import functools
+import glob
+import hashlib
+import itertools
 import json
+import operator
 import os
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
 import threading
 import time
 import traceback
+import uuid
+import zlib
+
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
 
 if os.getenv("GAE_INSTANCE") is not None:
     # Used in Google Appengine, so use Google datastore
+    from google.api_core import exceptions as gexceptions
     from google.cloud import datastore
+    from google.cloud.datastore import helpers as datastore_helpers
+    from google.cloud.datastore_v1.types import datastore as datastore_pb2
     DSCLIENT = datastore.Client()
     USE_GOOGLE_DATASTORE = True
+    USE_SQLITE = False
+    USE_MEMORY = False
+elif os.getenv("BUNQ2IFTTT_STORAGE") == "sqlite":
+    # Use a local SQLite database
+    USE_GOOGLE_DATASTORE = False
+    USE_SQLITE = True
+    USE_MEMORY = False
+    SQLITE_PATH = os.getenv("BUNQ2IFTTT_SQLITE_PATH",
+                            "db" + os.sep + "storage.sqlite3")
+elif os.getenv("BUNQ2IFTTT_STORAGE") == "memory":
+    # Keep everything in memory
+    USE_GOOGLE_DATASTORE = False
+    USE_SQLITE = False
+    USE_MEMORY = True
 else:
     # Use local datastore
     USE_GOOGLE_DATASTORE = False
+    USE_SQLITE = False
+    USE_MEMORY = False
 
 LOCK = threading.Lock()
 
 
+# Profiling
+#-----------
+# With BUNQ2IFTTT_PROFILE=1 every public function of this module records,
+# per (function, kind), the number of calls and errors, the total time, a
+# latency histogram and the bytes read from and written to the storage.
+# Only the outermost call is recorded, e.g. a query and not the query_page
+# calls it makes, and it gets the bytes of the calls it made. Calls slower
+# than BUNQ2IFTTT_PROFILE_SLOW_MS milliseconds are logged. Without
+# profiling the functions are not wrapped at all.
+
+PROFILE = os.getenv("BUNQ2IFTTT_PROFILE") == "1"
+PROFILE_SLOW_MS = float(os.getenv("BUNQ2IFTTT_PROFILE_SLOW_MS", "100"))
+PROFILE_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+PROFILE_STATS = {}
+PROFILE_LOCK = threading.Lock()
+PROFILE_CURRENT = threading.local()
+
+def profiled(func):
+    """ Decorator to record the calls of a storage function, when profiling
+        is enabled. The first argument of the function is the kind. """
+    if not PROFILE:
+        return func
+    @functools.wraps(func)
+    def wrapper(kind, *args, **kwargs):
+        if getattr(PROFILE_CURRENT, "op", None) is not None:
+            return func(kind, *args, **kwargs) # part of an outer call
+        PROFILE_CURRENT.op = {"read": 0, "written": 0}
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = func(kind, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            profile_record(func.__name__, str(kind), elapsed,
+                           PROFILE_CURRENT.op, failed)
+            PROFILE_CURRENT.op = None
+    return wrapper
+
+def profile_record(name, kind, elapsed, op, failed):
+    """ Helper method to add a call to the profile """
+    with PROFILE_LOCK:
+        stats = PROFILE_STATS.setdefault(name, {}).setdefault(kind, {
+            "count": 0, "errors": 0, "time_ms": 0.0, "bytes_read": 0,
+            "bytes_written": 0,
+            "histogram": [0] * (len(PROFILE_BUCKETS_MS) + 1)})
+        stats["count"] += 1
+        stats["errors"] += failed
+        stats["time_ms"] += elapsed
+        stats["bytes_read"] += op["read"]
+        stats["bytes_written"] += op["written"]
+        stats["histogram"][bisect.bisect_left(PROFILE_BUCKETS_MS,
+                                              elapsed)] += 1
+    if elapsed >= PROFILE_SLOW_MS:
+        print("[storage] slow {} {}: {:.1f} ms, {} bytes read, {} bytes "
+              "written".format(name, kind, elapsed, op["read"],
+                               op["written"]))
+
+def profile_bytes(read=0, written=0):
+    """ Helper method to add bytes read or written to the current call """
+    op = getattr(PROFILE_CURRENT, "op", None)
+    if op is not None:
+        op["read"] += read
+        op["written"] += written
+
+def profile_stats():
+    """ Return the profile: per function and kind the number of calls and
+        errors, the total time, the bytes read and written, and the number
+        of calls per latency bucket (up to each of PROFILE_BUCKETS_MS
+        milliseconds, the last one for slower calls) """
+    with PROFILE_LOCK:
+        return json.loads(json.dumps({"enabled": PROFILE,
+                                      "buckets_ms": PROFILE_BUCKETS_MS,
+                                      "stats": PROFILE_STATS}))
+
+
+@profiled
 def query_indexes(kind):
     """ Query all indexes for the given kind """
     if USE_GOOGLE_DATASTORE:
@@ -33,92 +190,301 @@ def query_indexes(kind):
         qry.keys_only()
         for entity in qry.fetch():
             result.append(entity.key.id_or_name)
+    elif USE_SQLITE:
+        result = [row[0] for row in sqlite_connection().execute(
+            "SELECT id FROM records WHERE kind = ?", (kind, ))]
+    elif USE_MEMORY:
+        with MEMORY_LOCK:
+            result = list(MEMORY.get(kind, {}))
     else:
-        fname = "db" + os.sep + str(kind) + os.sep
-        try:
-            result = os.listdir(fname)
-        except FileNotFoundError:
-            pass
+        result = list(local_names(kind))
     return result
 
-def query_all(kind):
-    """ Query all stored data of the given kind """
-    result = []
+def iter_indexes(kind, page_size=500):
+    """ Generator for the indexes of the given kind, reading page_size at a
+        time """
+    cursor = None
+    while True:
+        names, cursor = query_indexes_page(kind, page_size, cursor)
+        yield from names
+        if cursor is None:
+            return
+
+@profiled
+def query_indexes_page(kind, page_size=500, cursor=None):
+    """ Query one page of indexes of the given kind, returns a (indexes,
+        cursor) tuple like query_page """
     if USE_GOOGLE_DATASTORE:
         qry = DSCLIENT.query(kind=kind)
-        for entity in qry.fetch():
-            data = {'id': entity.key.id_or_name}
-            for key in entity.keys():
-                data[key] = json.loads(entity[key])
-            result.append(data)
+        qry.keys_only()
+        fetched = qry.fetch(limit=page_size, start_cursor=cursor)
+        result = [entity.key.id_or_name
+                  for entity in next(fetched.pages, [])]
+        cursor = fetched.next_page_token
+        if isinstance(cursor, bytes):
+            cursor = cursor.decode("ascii")
+        if not result:
+            cursor = None
+    elif USE_SQLITE:
+        sql = "SELECT id FROM records WHERE kind = ?"
+        params = [kind]
+        if cursor is not None:
+            sql += " AND id > ?"
+            params.append(cursor)
+        result = [row[0] for row in sqlite_connection().execute(
+            sql + " ORDER BY id LIMIT ?", params + [page_size])]
+        cursor = result[-1] if len(result) == page_size else None
+    elif USE_MEMORY:
+        with MEMORY_LOCK:
+            names = sorted(MEMORY.get(kind, {}))
+        start = 0 if cursor is None else bisect.bisect_right(names, cursor)
+        result = names[start:start+page_size]
+        cursor = result[-1] if len(result) == page_size else None
     else:
-        base = "db" + os.sep + str(kind) + os.sep
-        try:
-            names = os.listdir(base)
-        except FileNotFoundError:
-            return result
-        for fname in names:
-            with open(base + fname) as fil:
-                data = json.loads(fil.read())
-                data['id'] = fname
-                result.append(data)
-    return result
+        result = list(itertools.islice(local_names(kind, cursor), page_size))
+        cursor = result[-1] if len(result) == page_size else None
+    return result, cursor
+
+@profiled
+def query_all(kind):
+    """ Query all stored data of the given kind """
+    return list(iter_all(kind, page_size=500))
+
+
+@profiled
+def query(kind, label, comparator, value, labels=None):
+    """ Query stored data and return all that satisfy the given condition.
+        If labels is given, only those labels (and the id) are returned. """
+    return list(iter_query(kind, label, comparator, value, page_size=500,
+                           labels=labels))
+
 
+def iter_all(kind, page_size=100, limit=None, cursor=None):
+    """ Generator for all stored data of the given kind, reading page_size
+        records at a time """
+    return iter_query(kind, None, None, None, page_size, limit, cursor)
 
-def query(kind, label, comparator, value):
-    """ Query stored data and return all that satisfy the given condition """
+def iter_query(kind, label, comparator, value, page_size=100, limit=None,
+               cursor=None, labels=None):
+    """ Generator for the stored data that satisfy the given condition,
+        reading page_size records at a time. Use query_page to be able to
+        resume later. """
+    count = 0
+    while limit is None or count < limit:
+        size = page_size if limit is None else min(page_size, limit - count)
+        records, cursor = query_page(kind, label, comparator, value, size,
+                                     cursor, labels)
+        for data in records:
+            yield data
+        count += len(records)
+        if cursor is None:
+            return
+
+@profiled
+def query_page(kind, label=None, comparator=None, value=None, page_size=100,
+               cursor=None, labels=None):
+    """ Query one page of stored data of the given kind, that satisfy the
+        given condition if a label is given. Returns a (records, cursor)
+        tuple, where cursor is passed to the next call to continue after
+        this page, and is None after the last page. If labels is given,
+        only those labels (and the id) of the records are returned, and
+        where possible only those are decoded. """
+    if label is not None and kind in PACKED and label not in PACKED[kind]:
+        raise ValueError("Label not indexed for {}: {}".format(kind, label))
+    if label is not None and comparator not in COMPARATORS:
+        raise ValueError("Invalid comparator: "+comparator)
+    # pending updates in the journal are applied to the whole record
+    decode = labels if not JOURNAL_UPDATES else None
     result = []
     if USE_GOOGLE_DATASTORE:
         qry = DSCLIENT.query(kind=kind)
-        qry.add_filter(label, comparator, json.dumps(value))
-        for entity in qry.fetch():
-            data = {'id': entity.key.id_or_name}
-            for key in entity.keys():
-                data[key] = json.loads(entity[key])
+        if label is not None:
+            qry.add_filter(label, comparator, json.dumps(value))
+        fetched = qry.fetch(limit=page_size, start_cursor=cursor)
+        for entity in next(fetched.pages, []):
+            data = entity_to_dict(entity, decode)
+            pop_version(data)
+            data['id'] = entity.key.id_or_name
             result.append(data)
+        cursor = fetched.next_page_token
+        if isinstance(cursor, bytes):
+            cursor = cursor.decode("ascii")
+        if not result:
+            cursor = None
+    elif USE_SQLITE:
+        sql = "SELECT id, {} FROM records WHERE kind = ?".format(
+            "data" if decode is None else sqlite_projection(decode))
+        params = [kind]
+        if label is not None:
+            sql += " AND {} {} ?".format(sqlite_label(label), comparator)
+            params.append(value)
+        if cursor is not None:
+            sql += " AND id > ?"
+            params.append(cursor)
+        sql += " ORDER BY id LIMIT ?"
+        params.append(page_size)
+        for index, text in sqlite_connection().execute(sql, params):
+            data = json.loads(text)
+            if decode is not None:
+                values, types = data
+                data = {key: val for key, val, typ
+                        in zip(decode, values, types) if typ is not None}
+            pop_version(data)
+            data['id'] = index
+            result.append(data)
+        cursor = result[-1]['id'] if len(result) == page_size else None
+    elif USE_MEMORY:
+        result, cursor = memory_query(kind, label, comparator, value,
+                                      page_size, cursor)
     else:
-        base = "db" + os.sep + str(kind) + os.sep
-        try:
-            names = os.listdir(base)
-        except FileNotFoundError:
-            return result
-        for fname in names:
-            with open(base + fname) as fil:
-                data = json.loads(fil.read())
+        if comparator == "=":
+            names = sorted(index_names(kind, label, value))
+            start = 0 if cursor is None else bisect.bisect_right(names, cursor)
+            names = iter(names[start:])
+            # read around the cache: the callbacks of other processes
+            # must see changed, edited and removed records right away
+            read = functools.partial(retrieve_many_cached, cached=False)
+        else:
+            # walk the shards from the one holding the cursor
+            names = local_names(kind, cursor)
+            read = retrieve_many_local
+        cursor = None
+        while len(result) < page_size:
+            chunk = list(itertools.islice(names, page_size - len(result)))
+            if not chunk:
+                cursor = None
+                break
+            cursor = chunk[-1]
+            for fname, data in zip(chunk, read(kind, chunk)):
+                # skip stale index entries and records without the label
+                if data is None or (label is not None and not (
+                        label in data and
+                        COMPARATORS[comparator](data[label], value))):
+                    continue
                 data['id'] = fname
-            if comparator == "=" and data[label] == value:
-                result.append(data)
-            elif comparator == "<" and data[label] < value:
-                result.append(data)
-            elif comparator == "<=" and data[label] <= value:
-                result.append(data)
-            elif comparator == ">" and data[label] > value:
                 result.append(data)
-            elif comparator == ">=" and data[label] >= value:
-                result.append(data)
-    return result
+    if PROFILE and (USE_GOOGLE_DATASTORE or USE_SQLITE or USE_MEMORY):
+        profile_bytes(read=sum(len(json.dumps(data)) for data in result))
+    for data in result:
+        decompress_record(data)
+    if JOURNAL_UPDATES:
+        result = [journal_apply(kind, data['id'], data) for data in result]
+    if labels is not None:
+        result = [{key: val for key, val in data.items()
+                   if key in labels or key == 'id'} for data in result]
+    return result, cursor
 
+COMPARATORS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
 
+
+@profiled
 def retrieve(kind, index):
     """ Retrieve a previously stored dict """
-    index = str(index)
+    return retrieve_many(kind, [index])[0]
+
+@profiled
+def retrieve_many(kind, indexes):
+    """ Retrieve several previously stored dicts at once, in a single round
+        trip to the storage. Returns a list in the order of indexes, with
+        None for missing records. """
+    indexes = [str(index) for index in indexes]
+    result = retrieve_many_cached(kind, indexes)
+    if JOURNAL_UPDATES:
+        result = [journal_apply(kind, index, data)
+                  for index, data in zip(indexes, result)]
+    return result
+
+def retrieve_many_cached(kind, indexes, cached=True):
+    """ Helper method to retrieve several records, from the current batch,
+        the cache or the storage. With cached=False the cache is bypassed,
+        for records that other processes change often. """
+    result = {}
+    missing = []
+    for index in indexes:
+        if index in result:
+            continue
+        hit, data = batch_get(kind, index)
+        if not hit and cached and kind in CACHE_KINDS:
+            hit, data = cache_get(kind, index)
+        result[index] = data
+        if not hit:
+            missing.append(index)
+    if missing:
+        generation = CACHE_GENERATION[0]
+        fetched = retrieve_many_uncached(kind, missing)
+        for index in missing:
+            result[index] = fetched.get(index)
+            if cached and kind in CACHE_KINDS:
+                cache_put(kind, index, result[index], generation)
+    for data in result.values():
+        pop_version(data)
+    return [result[index] for index in indexes]
+
+def retrieve_many_uncached(kind, indexes):
+    """ Helper method to retrieve several records from the storage itself,
+        returns a dict of the found records by index """
+    result = {}
     if USE_GOOGLE_DATASTORE:
-        key = DSCLIENT.key(kind, index)
-        entity = DSCLIENT.get(key)
-        if entity is None:
-            return None
-        result = {}
-        for label in entity.keys():
-            result[label] = json.loads(entity[label])
-        return result
-    fname = "db" + os.sep + str(kind) + os.sep + str(index)
-    if os.path.isfile(fname):
-        with open(fname) as fil:
-            data = json.loads(fil.read())
-            return data
-    return None
+        for start in range(0, len(indexes), 1000):
+            keys = [DSCLIENT.key(kind, index)
+                    for index in indexes[start:start+1000]]
+            for entity in DSCLIENT.get_multi(keys):
+                result[entity.key.id_or_name] = entity_to_dict(entity)
+    elif USE_SQLITE:
+        for start in range(0, len(indexes), 500):
+            chunk = indexes[start:start+500]
+            for index, text in sqlite_connection().execute(
+                    "SELECT id, data FROM records WHERE kind = ? AND id IN "
+                    "({})".format(", ".join("?" * len(chunk))),
+                    [kind] + chunk):
+                result[index] = json.loads(text)
+    elif USE_MEMORY:
+        with MEMORY_LOCK:
+            records = MEMORY.get(kind, {})
+            texts = [(index, records.get(index)) for index in indexes]
+        for index, text in texts:
+            if text is not None:
+                result[index] = json.loads(text)
+    else:
+        for index in indexes:
+            data = retrieve_local(kind, index)
+            if data is not None:
+                result[index] = data
+    if PROFILE and (USE_GOOGLE_DATASTORE or USE_SQLITE or USE_MEMORY):
+        profile_bytes(read=sum(len(json.dumps(data))
+                               for data in result.values()))
+    for data in result.values():
+        decompress_record(data)
+    return result
 
+def retrieve_many_local(kind, indexes):
+    """ Helper method to read several records from local storage, without
+        the cache and versions """
+    result = [retrieve_local(kind, index) for index in indexes]
+    for data in result:
+        pop_version(data)
+    return result
+
+def retrieve_local(kind, index):
+    """ Helper method to read a record from local storage """
+    # records are replaced atomically, so no lock is needed
+    try:
+        with open(local_path(kind, index)) as fil:
+            text = fil.read()
+    except FileNotFoundError:
+        return None
+    if PROFILE:
+        profile_bytes(read=len(text))
+    return json.loads(text)
 
+
+@profiled
 def get_value(kind, index):
     """ Retrieve a previously stored value """
     data = retrieve(kind, index)
@@ -127,121 +493,1673 @@ def get_value(kind, index):
     return data
 
 
+@profiled
 def store(kind, index, value):
     """ Store a dict """
-    index = str(index)
-    if USE_GOOGLE_DATASTORE:
-        entity = datastore.Entity(key=DSCLIENT.key(kind, index))
-        for label in value:
-            entity[label] = json.dumps(value[label])
-        DSCLIENT.put(entity)
-    else:
-        fname = "db" + os.sep + str(kind)
-        os.makedirs(fname, exist_ok=True)
-        fname += os.sep + str(index)
-        with open(fname, "w") as fil:
-            fil.write(json.dumps(value))
+    write(kind, str(index), value, False)
 
 
+@profiled
 def store_large(kind, index, value):
     """ Store a large (not indexed) value """
-    index = str(index)
-    if USE_GOOGLE_DATASTORE:
-        entity = datastore.Entity(key=DSCLIENT.key(kind, index),
-                                  exclude_from_indexes=['value'])
-        entity["value"] = json.dumps(value)
-        DSCLIENT.put(entity)
-    else:
-        fname = "db" + os.sep + str(kind)
-        os.makedirs(fname, exist_ok=True)
-        fname += os.sep + str(index)
-        with open(fname, "w") as fil:
-            fil.write(json.dumps({"value": value}))
+    write(kind, str(index), {"value": value}, True)
 
 
+@profiled
 def insert_value_maxsize(kind, index, value, maxsize):
     """ Add a value to the beginning of a stored array, keeping a given maximum
         number of records. """
-    values = get_value(kind, index)
-    if values is None:
+    insert_value_maxsize_many(kind, [index], value, maxsize)
+
+@profiled
+def insert_value_maxsize_many(kind, indexes, value, maxsize):
+    """ Add a value to the beginning of several stored arrays, keeping a given
+        maximum number of records. All arrays are read and written at once.
+        Within a batch the values are inserted at the end of the batch. """
+    # take a copy, the caller may still modify value
+    value = json.loads(json.dumps(value))
+    appends = [(kind, str(index), value, maxsize) for index in indexes]
+    if in_batch():
+        BATCH.appends.extend(appends)
+    else:
+        write_many({}, appends)
+
+def append_many(appends):
+    """ Helper method to insert values into ring buffers. The heads are
+        written with a version check, so concurrent inserts into the same
+        ring buffer are retried instead of overwriting each other. """
+    for attempt in range(RETRIES):
+        heads = retrieve_versions([(kind, index)
+                                   for kind, index, _, _ in appends])
+        groups = collections.OrderedDict()
+        for kind, index, value, maxsize in appends:
+            if (kind, index) not in groups:
+                head = heads[(kind, index)][0]
+                writes = collections.OrderedDict()
+                if head is None:
+                    head = {"head": 0, "maxsize": maxsize}
+                elif "value" in head:
+                    head = convert_values(writes, kind, index, head["value"],
+                                          maxsize)
+                groups[(kind, index)] = (head, writes)
+            head, writes = groups[(kind, index)]
+            slot = head["head"] % head["maxsize"]
+            writes[(kind, index + "." + str(slot))] = ({"value": value}, True)
+            head["head"] += 1
+        # one commit for all ring buffers, unless that gets too large for a
+        # single Google datastore transaction
+        failed = set()
+        writes, expected = collections.OrderedDict(), {}
+        for key, (head, headwrites) in groups.items():
+            if writes and len(writes) + len(headwrites) >= 500:
+                if not commit(writes, expected):
+                    failed.update(expected)
+                writes, expected = collections.OrderedDict(), {}
+            writes.update(headwrites)
+            writes[key] = (head, True)
+            expected[key] = heads[key][1]
+        if writes and not commit(writes, expected):
+            failed.update(expected)
+        appends = [append for append in appends
+                   if (append[0], append[1]) in failed]
+        if not appends:
+            return
+        backoff(attempt)
+    raise VersionConflict("Too many concurrent inserts: {}".format(
+        ", ".join(sorted(set(index for _, index, _, _ in appends)))))
+
+@profiled
+def get_latest_values(kind, index, limit):
+    """ Retrieve the newest values of an array stored with
+        insert_value_maxsize, newest first """
+    # heads and slots are changed by the callbacks in any process, so they
+    # are never cached, also not when the kind of the array is
+    index = str(index)
+    pending = journal_values(kind, index)
+    head = retrieve_many_cached(kind, [index], False)[0]
+    if head is None:
         values = []
-    values.insert(0, value)
+    elif "value" in head:
+        values = head["value"][:limit]
+    else:
+        count = min(limit, head["head"], head["maxsize"])
+        slots = [index + "." + str((head["head"] - 1 - i) % head["maxsize"])
+                 for i in range(count)]
+        values = [data["value"] for data in
+                  retrieve_many_cached(kind, slots, False)
+                  if data is not None]
+    if pending:
+        # skip values that were written while reading
+        values = pending + [value for value in values if value not in pending]
+    return values[:limit]
+
+@profiled
+def remove_values(kind, index):
+    """ Remove an array stored with insert_value_maxsize """
+    index = str(index)
+    head = retrieve_many_cached(kind, [index], False)[0]
+    with batch():
+        if head is not None and "value" not in head:
+            for slot in range(head["maxsize"]):
+                remove(kind, index + "." + str(slot))
+        remove(kind, index)
+
+@profiled
+def remove_cascade(kind, index, histories=()):
+    """ Remove a record together with the arrays stored with
+        insert_value_maxsize that belong to it, given as a list of
+        (kind, index) tuples, all in a single batch """
+    with batch():
+        remove(kind, index)
+        for hkind, hindex in histories:
+            remove_values(hkind, hindex)
+    for hkind, hindex in histories:
+        journal_discard(hkind, str(hindex))
+
+@profiled
+def remove_orphans(kind, owner_kind, suffix="_t"):
+    """ Remove the arrays stored with insert_value_maxsize in kind, named
+        <index><suffix>, for which owner_kind has no record <index>. Returns
+        the number of removed records. """
+    pattern = re.compile(r"(.*)" + re.escape(suffix) + r"(\.\d+)?")
+    owners = set(str(name) for name in iter_indexes(owner_kind))
+    def find_candidates():
+        for name in iter_indexes(kind):
+            match = pattern.fullmatch(str(name))
+            if match and match.group(1) not in owners:
+                yield str(name), match.group(1)
+    candidates = find_candidates()
+    removed = 0
+    while True:
+        chunk = list(itertools.islice(candidates, 500))
+        if not chunk:
+            return removed
+        # the arrays are listed after the owners, so check that the owners
+        # weren't created in between
+        found = retrieve_many_uncached(owner_kind,
+                                       sorted(set(o for _, o in chunk)))
+        orphans = [name for name, owner in chunk if owner not in found]
+        with batch():
+            for name in orphans:
+                remove(kind, name)
+        for name in orphans:
+            journal_discard(kind, name)
+        removed += len(orphans)
+
+def convert_values(writes, kind, index, values, maxsize):
+    """ Helper method to convert an array stored as a single value (the
+        format before ring buffers were used) to a ring buffer """
     values = values[:maxsize]
-    store_large(kind, index, values)
+    for slot, value in enumerate(reversed(values)):
+        writes[(kind, index + "." + str(slot))] = ({"value": value}, True)
+    return {"head": len(values), "maxsize": maxsize}
 
 
+@profiled
 def remove(kind, index):
     """ Remove the given record """
+    write(kind, str(index), None, False)
+
+
+def write(kind, index, data, large):
+    """ Write a record, or remove it if data is None. Within a batch the
+        write is postponed until the end of the batch. """
+    writes = getattr(BATCH, "writes", None)
+    if writes is not None:
+        # take a copy, the caller may still modify data
+        writes[(kind, index)] = (json.loads(json.dumps(data)), large)
+        return
+    write_many({(kind, index): (data, large)})
+
+def write_many(writes, appends=()):
+    """ Write a set of records and insert values into ring buffers, in as few
+        round trips as possible. writes is a dict of (data, large) tuples by
+        (kind, index), appends a list of (kind, index, value, maxsize)
+        tuples. """
+    if writes:
+        commit(writes)
+    if appends:
+        append_many(appends)
+
+
+# Versions
+#----------
+# Every write stores a version number in the record (label "_version",
+# removed again by all retrieve and query methods). store_if_version only
+# writes when a record still has the version that was read, so concurrent
+# read-modify-write cycles (see update) are retried instead of silently
+# overwriting each other. Records stored before versions were added have
+# version 0, missing records have version None.
+#
+# Locally, a commit locks the records it writes or checks, on one of
+# LOCAL_LOCK_STRIPES stripes: a lock within this process, and an flock on
+# db/.lock/<stripe> for worker processes sharing the db/ directory (not on
+# Windows, which has no fcntl).
+
+RETRIES = 10
+VERSION = [0]
+VERSION_LOCK = threading.Lock()
+LOCAL_LOCK_STRIPES = 64
+LOCAL_LOCK_DIR = "db" + os.sep + ".lock"
+LOCAL_LOCKS = [threading.RLock() for _ in range(LOCAL_LOCK_STRIPES)]
+LOCAL_LOCKS_HELD = threading.local()
+
+class VersionConflict(Exception):
+    """ A conditional write kept failing because of concurrent writes """
+
+@profiled
+def retrieve_versioned(kind, index):
+    """ Retrieve a previously stored dict and its version, bypassing the
+        cache. Returns (None, None) for a missing record. """
     index = str(index)
+    return retrieve_versions([(kind, index)])[(kind, index)]
+
+@profiled
+def store_if_version(kind, index, value, expected_version, large=False):
+    """ Store a dict (or a large value, like store_large), but only if the
+        stored record still has the given version. Returns whether it was
+        stored. The write is done immediately, also within a batch. """
+    index = str(index)
+    if large:
+        value = {"value": value}
+    return commit({(kind, index): (value, large)},
+                  {(kind, index): expected_version})
+
+@profiled
+def update(kind, index, change, large=False):
+    """ Change a stored dict without losing concurrent updates. change is
+        called with the stored dict (or None) and returns the new dict, or
+        None to leave the record as it is; it is called again when another
+        writer got in between. With large=True change gets and returns the
+        value of a record stored with store_large. Returns the new dict or
+        value, or None if nothing was changed. Within a deferred batch in
+        write-behind mode the change is added to the journal. """
+    index = str(index)
+    if WRITE_BEHIND and in_batch() and BATCH.deferred:
+        return journal_update(kind, index, change, large)
+    for attempt in range(RETRIES):
+        data, version = retrieve_versioned(kind, index)
+        if large and data is not None:
+            data = data["value"]
+        data = change(data)
+        if data is None:
+            return None
+        if store_if_version(kind, index, data, version, large):
+            return data
+        backoff(attempt)
+    raise VersionConflict("Too many concurrent updates: {} {}"
+                          .format(kind, index))
+
+@profiled
+def update_many(kind, indexes, change):
+    """ Change several stored dicts like update, all read at once and
+        written in a single commit. change is called with the index and the
+        stored dict (or None) of each record. Returns a dict of the new
+        dicts by index, for the changed records only. """
+    indexes = list(collections.OrderedDict.fromkeys(str(index)
+                                                    for index in indexes))
+    if WRITE_BEHIND and in_batch() and BATCH.deferred:
+        result = {}
+        for index in indexes:
+            data = journal_update(kind, index,
+                                  functools.partial(change, index), False)
+            if data is not None:
+                result[index] = data
+        return result
+    for attempt in range(RETRIES):
+        current = retrieve_versions([(kind, index) for index in indexes])
+        writes, expected = collections.OrderedDict(), {}
+        result = {}
+        for index in indexes:
+            data, version = current[(kind, index)]
+            data = change(index, data)
+            if data is None:
+                continue
+            writes[(kind, index)] = (data, False)
+            expected[(kind, index)] = version
+            result[index] = data
+        if not writes or commit(writes, expected):
+            return result
+        backoff(attempt)
+    raise VersionConflict("Too many concurrent updates: {} {}"
+                          .format(kind, ", ".join(indexes)))
+
+def retrieve_versions(keys):
+    """ Helper method to read records with their versions from the storage
+        itself. keys is a list of (kind, index) tuples, returns a dict of
+        (data, version) tuples by key. """
+    kinds = collections.OrderedDict()
+    for kind, index in collections.OrderedDict.fromkeys(keys):
+        kinds.setdefault(kind, []).append(index)
+    result = {}
+    for kind, indexes in kinds.items():
+        fetched = retrieve_many_uncached(kind, indexes)
+        for index in indexes:
+            data = fetched.get(index)
+            result[(kind, index)] = (data, pop_version(data))
+    return result
+
+def pop_version(data):
+    """ Helper method to remove the version from a stored record, returns
+        the version """
+    if data is None:
+        return None
+    return data.pop("_version", 0)
+
+def next_version():
+    """ Helper method to return a new version number, based on the clock
+        and increasing within this process """
+    with VERSION_LOCK:
+        VERSION[0] = max(VERSION[0] + 1, time.time_ns())
+        return VERSION[0]
+
+def backoff(attempt):
+    """ Helper method to wait a random, increasing time before a retry """
+    time.sleep(random.uniform(0, 0.005 * 2 ** min(attempt, 6)))
+
+def commit(writes, expected=None):
+    """ Write a set of records at once, writes is a dict of (data, large)
+        tuples by (kind, index). If expected is given, a dict of versions by
+        (kind, index), nothing is written unless all those records still
+        have that version. Returns whether the records were written. """
+    expected = expected or {}
+    version = next_version()
+    stamped = collections.OrderedDict()
+    for key, (data, large) in writes.items():
+        if data is not None:
+            data = dict(data, _version=version)
+            if large and key[0] in COMPRESSED:
+                data = compress_record(data)
+        stamped[key] = (data, large)
+    if PROFILE:
+        profile_bytes(written=sum(len(json.dumps(data))
+                                  for data, _ in stamped.values()
+                                  if data is not None))
     if USE_GOOGLE_DATASTORE:
-        print("delete: ", kind, index)
-        DSCLIENT.delete(DSCLIENT.key(kind, index))
+        result = commit_google(stamped, expected)
+    elif USE_SQLITE:
+        result = commit_sqlite(stamped, expected)
+    elif USE_MEMORY:
+        result = commit_memory(stamped, expected)
     else:
-        fname = "db" + os.sep + str(kind) + os.sep + str(index)
+        result = commit_local(stamped, expected)
+    for kind, index in list(writes) + list(expected):
+        cache_invalidate(kind, index)
+    return result
+
+def commit_google(writes, expected):
+    """ Helper method for commit, used with google datastore """
+    entities = []
+    keys = []
+    for (kind, index), (data, large) in writes.items():
+        if data is None:
+            print("delete: ", kind, index)
+            keys.append(DSCLIENT.key(kind, index))
+        else:
+            entities.append(dict_to_entity(kind, index, data, large))
+    if not expected:
+        for start in range(0, len(entities), 500):
+            DSCLIENT.put_multi(entities[start:start+500])
+        for start in range(0, len(keys), 500):
+            DSCLIENT.delete_multi(keys[start:start+500])
+        return True
+    try:
+        with DSCLIENT.transaction():
+            found = {}
+            for entity in DSCLIENT.get_multi([DSCLIENT.key(kind, index)
+                                              for kind, index in expected]):
+                found[(entity.key.kind, entity.key.id_or_name)] = \
+                    entity_to_dict(entity).get("_version", 0)
+            for key, version in expected.items():
+                if found.get(key) != version:
+                    return False
+            DSCLIENT.put_multi(entities)
+            DSCLIENT.delete_multi(keys)
+    except gexceptions.Conflict:
+        # a concurrent transaction wrote one of the records
+        return False
+    return True
+
+def commit_sqlite(writes, expected):
+    """ Helper method for commit, used with SQLite """
+    with sqlite_transaction() as conn:
+        for (kind, index), version in expected.items():
+            row = conn.execute("SELECT coalesce(json_extract(data, "
+                               "'$._version'), 0) FROM records WHERE "
+                               "kind = ? AND id = ?", (kind, index)).fetchone()
+            if (row[0] if row else None) != version:
+                return False
+        for (kind, index), (data, large) in writes.items():
+            if data is None:
+                conn.execute("DELETE FROM records WHERE kind = ? AND "
+                             "id = ?", (kind, index))
+            else:
+                conn.execute("INSERT OR REPLACE INTO records "
+                             "(kind, id, data) VALUES (?, ?, ?)",
+                             (kind, index, json.dumps(data)))
+    return True
+
+def commit_local(writes, expected):
+    """ Helper method for commit, used with the local storage """
+    with local_locks(list(writes) + list(expected)):
+        for (kind, index), version in expected.items():
+            if pop_version(retrieve_local(kind, index)) != version:
+                return False
+        for (kind, index), (data, large) in writes.items():
+            if data is None:
+                remove_local(kind, index)
+            else:
+                store_local(kind, index, data)
+    return True
+
+@contextlib.contextmanager
+def local_locks(keys):
+    """ Helper method to lock a set of local records, across processes when
+        possible. keys is a list of (kind, index) tuples. """
+    stripes = sorted(set(
+        int(hashlib.sha1("{}/{}".format(*key).encode("utf-8")).hexdigest(),
+            16) % LOCAL_LOCK_STRIPES for key in keys))
+    with contextlib.ExitStack() as stack:
+        for stripe in stripes:
+            stack.enter_context(LOCAL_LOCKS[stripe])
+            stack.enter_context(local_flock(stripe))
+        yield
+
+@contextlib.contextmanager
+def local_flock(stripe):
+    """ Helper method to take the flock of a stripe (or another name in
+        db/.lock), unless this thread holds it already """
+    held = LOCAL_LOCKS_HELD.__dict__.setdefault("stripes", set())
+    if fcntl is None or stripe in held:
+        yield
+        return
+    fname = LOCAL_LOCK_DIR + os.sep + str(stripe)
+    try:
+        fd = os.open(fname, os.O_RDWR | os.O_CREAT)
+    except FileNotFoundError:
+        os.makedirs(LOCAL_LOCK_DIR, exist_ok=True)
+        fd = os.open(fname, os.O_RDWR | os.O_CREAT)
+    held.add(stripe)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        held.discard(stripe)
+        os.close(fd) # releases the lock
+
+def store_local(kind, index, data):
+    """ Helper method to write a record to local storage, keeping the
+        secondary indexes of its kind up to date """
+    fname = local_path(kind, index)
+    if not os.path.isdir(os.path.dirname(fname)):
+        local_makedirs(kind, os.path.dirname(fname))
+    # index entries for the new values are added before the record is
+    # written and those of the old values removed after it, so a failed
+    # write leaves only stale entries, which queries skip
+    olddata = retrieve_local(kind, index) if index_labels(kind) else None
+    index_add(kind, index, olddata, data)
+    local_replace(kind, fname, json.dumps(data))
+    index_discard(kind, index, olddata, data)
+
+def local_replace(kind, fname, text):
+    """ Helper method to replace a local file atomically: the text is
+        written to a temporary file, which is then renamed, so readers see
+        either the old or the new file """
+    tmpdir = local_dir(kind) + os.sep + SHARD_TMP
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=tmpdir)
+    except FileNotFoundError:
+        os.makedirs(tmpdir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=tmpdir)
+    try:
+        with os.fdopen(fd, "w") as fil:
+            fil.write(text)
+            if LOCAL_FSYNC:
+                fil.flush()
+                os.fsync(fil.fileno())
+        os.replace(tmpname, fname)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmpname)
+        raise
+    if LOCAL_FSYNC:
+        # make the rename itself durable
+        dirfd = os.open(os.path.dirname(fname), os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+def remove_local(kind, index):
+    """ Helper method to remove a record from local storage """
+    fname = local_path(kind, index)
+    olddata = retrieve_local(kind, index) if index_labels(kind) else None
+    try:
         os.remove(fname)
-        try: # try removing empty directories
-            os.removedirs(fname)
-        except OSError:
+    except FileNotFoundError:
+        pass
+    index_discard(kind, index, olddata, None)
+
+def entity_to_dict(entity, labels=None):
+    """ Helper method to decode a Google datastore entity, or only the given
+        labels of it """
+    if "_data" in entity:
+        return json.loads(entity["_data"])
+    result = {}
+    for label in entity.keys():
+        if labels is None or label in labels:
+            result[label] = json.loads(entity[label])
+    return result
+
+def dict_to_entity(kind, index, data, large):
+    """ Helper method to encode a Google datastore entity """
+    if large:
+        entity = datastore.Entity(key=DSCLIENT.key(kind, index),
+                                  exclude_from_indexes=list(data))
+    elif kind in PACKED:
+        entity = datastore.Entity(key=DSCLIENT.key(kind, index),
+                                  exclude_from_indexes=["_data"])
+        entity["_data"] = json.dumps(data, separators=(",", ":"))
+        for label in PACKED[kind]:
+            if label in data:
+                entity[label] = json.dumps(data[label])
+        return entity
+    else:
+        entity = datastore.Entity(key=DSCLIENT.key(kind, index),
+                                  exclude_from_indexes=["_version"])
+    for label in data:
+        entity[label] = json.dumps(data[label])
+    return entity
+
+
+# Packed records
+#----------------
+# On Google datastore every label of a record is a separate, indexed
+# property by default. Kinds registered with enable_packing() are stored as
+# a single unindexed "_data" property holding the whole record, plus copies
+# of only the labels that are queried. Decoding such a record is a single
+# json.loads. Records stored before are still decoded property by property,
+# until they are rewritten by the next store or by repack(), which is run
+# once after upgrading from the /repack admin page. The local and
+# SQLite storage already store each record as a single JSON document.
+
+PACKED = {}
+
+def enable_packing(kind, indexed):
+    """ Store (not large) records of the given kind as a single packed
+        property, with only the given labels indexed for queries """
+    PACKED[kind] = list(indexed)
+
+@profiled
+def repack(kind):
+    """ Rewrite the records of a packed kind that are stored property by
+        property, returns the number of rewritten records """
+    if not USE_GOOGLE_DATASTORE or kind not in PACKED:
+        return 0
+    count = 0
+    writes, expected = collections.OrderedDict(), {}
+    for entity in DSCLIENT.query(kind=kind).fetch():
+        # skip packed and large records
+        if "_data" in entity or \
+                set(entity.keys()) <= set(entity.exclude_from_indexes):
+            continue
+        data = entity_to_dict(entity)
+        key = (kind, entity.key.id_or_name)
+        expected[key] = pop_version(data)
+        writes[key] = (data, False)
+        if len(writes) == 100:
+            # records changed in the meantime are already packed
+            if commit(writes, expected):
+                count += len(writes)
+            writes, expected = collections.OrderedDict(), {}
+    if writes and commit(writes, expected):
+        count += len(writes)
+    return count
+
+
+# Compressed values
+#-------------------
+# Large values (store_large, history slots) of kinds registered with
+# enable_compression() are stored as zlib compressed, base64 encoded JSON in
+# the label "_zlib<n>" instead of "value", unless that doesn't save space.
+# Records without that label are read as they are, so values stored before
+# stay readable and are compressed by the next write. A history slot holds a
+# single item, which is too small for zlib to find much repetition in, so
+# compression starts from a preset dictionary with the labels of the items.
+# <n> is the version of that dictionary in COMPRESS_DICTS: to change it, add
+# a new version and keep the old ones, which are needed to read the values
+# compressed with them.
+
+COMPRESSED = set()
+COMPRESS_MINSIZE = 256
+COMPRESS_LEVEL = 6
+COMPRESS_DICTS = {
+    1: (b'{"created_at":"","date":"","type":"","amount":"","balance":"",'
+        b'"account":"NL","account_name":"","counterparty_account":"NL",'
+        b'"counterparty_name":"","description":"","payment_id":,'
+        b'"request_id":,"meta":{"id":,"timestamp":}}'),
+}
+COMPRESS_VERSION = max(COMPRESS_DICTS)
+COMPRESS_LABEL = re.compile(r"_zlib(\d+)")
+
+def enable_compression(kind):
+    """ Compress large values of the given kind """
+    COMPRESSED.add(kind)
+
+def compress_record(data):
+    """ Helper method to compress the value of a large record """
+    if set(data) - {"_version"} != {"value"}:
+        return data # e.g. the head of a ring buffer
+    text = json.dumps(data["value"], separators=(",", ":")).encode("utf-8")
+    if len(text) < COMPRESS_MINSIZE:
+        return data
+    compressor = zlib.compressobj(COMPRESS_LEVEL,
+                                  zdict=COMPRESS_DICTS[COMPRESS_VERSION])
+    packed = base64.b64encode(compressor.compress(text) + compressor.flush())
+    if len(packed) >= len(text):
+        return data
+    result = dict(data)
+    del result["value"]
+    result["_zlib" + str(COMPRESS_VERSION)] = packed.decode("ascii")
+    return result
+
+def decompress_record(data):
+    """ Helper method to decompress the value of a record in place, if it
+        was compressed """
+    if data is None:
+        return data
+    for label in list(data):
+        match = COMPRESS_LABEL.fullmatch(label)
+        if match:
+            zdict = COMPRESS_DICTS[int(match.group(1))]
+            decompressor = zlib.decompressobj(zdict=zdict)
+            text = decompressor.decompress(base64.b64decode(data.pop(label)))
+            data["value"] = json.loads(text.decode("utf-8"))
+    return data
+
+
+# Unit of work
+#--------------
+# Writes done within a 'with batch():' block are collected per thread and
+# written together at the end of the block: one put_multi/delete_multi on
+# Google datastore, one transaction for SQLite. Values inserted with
+# insert_value_maxsize are collected as well and inserted together with a
+# version check. Reads within the block see the collected writes. If the
+# block raises an exception, nothing is written.
+
+BATCH = threading.local()
+
+@contextlib.contextmanager
+def batch(deferred=False):
+    """ Collect all writes of the enclosed block and write them at once. If
+        deferred, history inserts and updates go to the write-behind
+        journal, when enabled. """
+    if in_batch():
+        yield # part of an enclosing batch
+        return
+    BATCH.writes = collections.OrderedDict()
+    BATCH.appends = []
+    BATCH.deferred = deferred
+    try:
+        yield
+        writes, appends = BATCH.writes, BATCH.appends
+    finally:
+        BATCH.writes = BATCH.appends = None
+    if WRITE_BEHIND and deferred:
+        write_many(writes)
+        journal_append(appends)
+    else:
+        write_many(writes, appends)
+
+def in_batch():
+    """ Return whether a batch is active in the current thread """
+    return getattr(BATCH, "writes", None) is not None
+
+def batch_get(kind, index):
+    """ Look up a record written in the current batch, returns a
+        (hit, data) tuple """
+    writes = getattr(BATCH, "writes", None)
+    if writes is None or (kind, index) not in writes:
+        return False, None
+    return True, json.loads(json.dumps(writes[(kind, index)][0]))
+
+
+# Write-behind journal
+#----------------------
+# When BUNQ2IFTTT_WRITE_BEHIND is set to a flush interval in milliseconds,
+# history inserts and updates done in a 'with batch(deferred=True):' block
+# are added to an in-process journal instead of being written. A
+# background thread writes the journal every interval, or as soon as it
+# holds BUNQ2IFTTT_WRITE_BEHIND_MAX entries, and it is written at exit and
+# on SIGTERM. Reads see the journal. With the local and SQLite storage the
+# journal is also appended to a file per process, db/journal/<pid>.log
+# (with fsync). Each process holds an flock on db/journal/<pid>.lock while
+# it runs; the files of a process that no longer holds its lock are
+# replayed at start and every JOURNAL_REPLAY_INTERVAL seconds by another
+# process. Without fcntl (Windows) write-behind is only supported without
+# a journal file, i.e. on Google datastore or in memory. Updates in the
+# journal are only atomic within this process. A process forked after the
+# journal started (e.g. a worker of gunicorn --preload) starts its own
+# journal, files and flush thread; the entries of its parent stay with the
+# parent.
+
+WRITE_BEHIND = int(os.getenv("BUNQ2IFTTT_WRITE_BEHIND", "0"))
+WRITE_BEHIND_MAX = int(os.getenv("BUNQ2IFTTT_WRITE_BEHIND_MAX", "100"))
+JOURNAL_DIR = "db" + os.sep + "journal"
+JOURNAL_REPLAY_INTERVAL = 60
+JOURNAL_PATH = [None] # db/journal/<pid>, without extension
+JOURNAL_LOCK_FD = [None]
+JOURNAL_UPDATES = collections.OrderedDict()
+JOURNAL_APPENDS = collections.OrderedDict()
+JOURNAL_FILE = [None]
+JOURNAL_LOCK = threading.RLock()
+JOURNAL_FLUSH_LOCK = threading.RLock()
+JOURNAL_EVENT = threading.Event()
+
+def journal_update(kind, index, change, large):
+    """ Helper method for update, adding the change to the journal """
+    with JOURNAL_LOCK:
+        data, _ = retrieve_versioned(kind, index)
+        data = journal_apply(kind, index, data, False)
+        if large and data is not None:
+            data = data["value"]
+        data = change(json.loads(json.dumps(data)))
+        if data is None:
+            return None
+        JOURNAL_UPDATES.setdefault((kind, index), []).append((change, large))
+        journal_log([{"kind": kind, "index": index, "large": large,
+                      "data": {"value": data} if large else data}])
+        count = sum(len(entries) for entries in
+                    list(JOURNAL_UPDATES.values()) +
+                    list(JOURNAL_APPENDS.values()))
+    if count >= WRITE_BEHIND_MAX:
+        JOURNAL_EVENT.set()
+    return data
+
+def journal_append(appends):
+    """ Helper method to add history inserts to the journal """
+    if not appends:
+        return
+    with JOURNAL_LOCK:
+        for kind, index, value, maxsize in appends:
+            JOURNAL_APPENDS.setdefault((kind, index), []).append(
+                (value, maxsize))
+        journal_log([{"kind": kind, "index": index, "value": value,
+                      "maxsize": maxsize}
+                     for kind, index, value, maxsize in appends])
+        count = sum(len(entries) for entries in
+                    list(JOURNAL_UPDATES.values()) +
+                    list(JOURNAL_APPENDS.values()))
+    if count >= WRITE_BEHIND_MAX:
+        JOURNAL_EVENT.set()
+
+def journal_apply(kind, index, data, lock=True):
+    """ Helper method to apply the updates in the journal to a record """
+    with JOURNAL_LOCK if lock else contextlib.nullcontext():
+        changes = list(JOURNAL_UPDATES.get((kind, index), []))
+    for change, large in changes:
+        value = data["value"] if large and data is not None else data
+        value = change(json.loads(json.dumps(value)))
+        if value is not None:
+            data = {"value": value} if large else value
+    return data
+
+def journal_values(kind, index):
+    """ Helper method to return the values in the journal for a history,
+        newest first """
+    if not JOURNAL_APPENDS:
+        return []
+    with JOURNAL_LOCK:
+        return [json.loads(json.dumps(value)) for value, _ in
+                reversed(JOURNAL_APPENDS.get((kind, index), []))]
+
+def journal_discard(kind, index):
+    """ Helper method to drop the history inserts in the journal for a
+        removed array """
+    with JOURNAL_LOCK:
+        JOURNAL_APPENDS.pop((kind, index), None)
+
+def journal_log(entries):
+    """ Helper method to append entries to the journal file """
+    fil = JOURNAL_FILE[0]
+    if fil is None:
+        return
+    for entry in entries:
+        fil.write(json.dumps(entry) + "\n")
+    fil.flush()
+    os.fsync(fil.fileno())
+
+def journal_flush():
+    """ Write all entries in the journal to the storage """
+    with JOURNAL_FLUSH_LOCK:
+        with JOURNAL_LOCK:
+            updates = [(key, list(changes))
+                       for key, changes in JOURNAL_UPDATES.items()]
+            appends = [(key, list(values))
+                       for key, values in JOURNAL_APPENDS.items()]
+            if not updates and not appends:
+                return
+            journal_rotate()
+        for (kind, index), changes in updates:
+            update(kind, index, journal_changes(changes), changes[0][1])
+        write_many({}, [(kind, index, value, maxsize)
+                        for (kind, index), values in appends
+                        for value, maxsize in values])
+        with JOURNAL_LOCK:
+            for journal, flushed in [(JOURNAL_UPDATES, updates),
+                                     (JOURNAL_APPENDS, appends)]:
+                for key, entries in flushed:
+                    if key not in journal:
+                        continue # discarded while flushing
+                    del journal[key][:len(entries)]
+                    if not journal[key]:
+                        del journal[key]
+        if JOURNAL_FILE[0] is not None:
+            os.remove(JOURNAL_PATH[0] + ".flushing")
+
+def journal_changes(changes):
+    """ Helper method to combine the changes of one record in the journal
+        into a single change """
+    def change(value):
+        changed = False
+        for func, _ in changes:
+            newvalue = func(json.loads(json.dumps(value)))
+            if newvalue is not None:
+                value, changed = newvalue, True
+        return value if changed else None
+    return change
+
+def journal_rotate():
+    """ Helper method to move the journal file aside while it is flushed,
+        adding to a journal file left by a failed flush """
+    fil = JOURNAL_FILE[0]
+    if fil is None:
+        return
+    fil.close()
+    path = JOURNAL_PATH[0]
+    if os.path.isfile(path + ".flushing"):
+        with open(path + ".log") as src, \
+                open(path + ".flushing", "a") as dst:
+            dst.write(src.read())
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(path + ".log")
+    else:
+        os.replace(path + ".log", path + ".flushing")
+    JOURNAL_FILE[0] = open(path + ".log", "a")
+
+def journal_replay():
+    """ Helper method to write the entries of the journal files of
+        processes that ended without flushing them """
+    if fcntl is None:
+        return
+    try:
+        names = os.listdir(JOURNAL_DIR)
+    except FileNotFoundError:
+        return
+    owners = sorted(set(name.split(".")[0] for name in names
+                        if name.endswith((".log", ".flushing"))))
+    for owner in owners:
+        path = JOURNAL_DIR + os.sep + owner
+        if path == JOURNAL_PATH[0]:
+            continue # our own journal
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue # the owner is still running
+            journal_replay_files(path)
+            os.remove(path + ".lock")
+        finally:
+            os.close(fd) # releases the lock
+
+def journal_replay_files(path):
+    """ Helper method to write the entries of the journal files of one
+        process, the caller must hold its lock """
+    writes = collections.OrderedDict()
+    appends = []
+    for fname in [path + ".flushing", path + ".log"]:
+        if not os.path.isfile(fname):
+            continue
+        with open(fname) as fil:
+            for line in fil:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # incomplete last line
+                if "value" in entry:
+                    appends.append((entry["kind"], entry["index"],
+                                    entry["value"], entry["maxsize"]))
+                else:
+                    writes[(entry["kind"], entry["index"])] = \
+                        (entry["data"], entry["large"])
+    if writes or appends:
+        print("[storage] Replaying {} journal entries of {}".format(
+            len(writes) + len(appends), path))
+        write_many(writes, appends)
+    for fname in [path + ".flushing", path + ".log"]:
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+def journal_lock():
+    """ Helper method to take the lock on the journal files of this process,
+        returns their path without extension """
+    path = JOURNAL_DIR + os.sep + str(os.getpid())
+    while True:
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            # another process may have removed the lock file of an ended
+            # process with the same pid while we waited for it
+            if os.fstat(fd).st_ino == os.stat(path + ".lock").st_ino:
+                JOURNAL_LOCK_FD[0] = fd
+                return path
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+def journal_start():
+    """ Start the write-behind journal: replay journal files left by a
+        crash, and start flushing in the background, at exit and on
+        SIGTERM """
+    if not USE_GOOGLE_DATASTORE and not USE_MEMORY:
+        if fcntl is None:
+            raise RuntimeError("BUNQ2IFTTT_WRITE_BEHIND needs fcntl with "
+                               "local or SQLite storage")
+        journal_open()
+    threading.Thread(target=journal_thread, daemon=True).start()
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(before=journal_fork_before,
+                            after_in_parent=journal_fork_after,
+                            after_in_child=journal_fork_child)
+    atexit.register(journal_flush)
+    try:
+        previous = signal.getsignal(signal.SIGTERM)
+        def sigterm(signum, frame):
+            journal_flush()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous != signal.SIG_IGN:
+                sys.exit(128 + signum)
+        signal.signal(signal.SIGTERM, sigterm)
+    except ValueError:
+        print("[storage] Can't flush the journal on SIGTERM, "
+              "not in the main thread")
+
+def journal_open():
+    """ Helper method to open the journal file of this process, replaying
+        journal files left by a crash """
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    path = journal_lock()
+    journal_replay_files(path) # left by an ended process with our pid
+    journal_replay()
+    JOURNAL_PATH[0] = path
+    JOURNAL_FILE[0] = open(path + ".log", "a")
+
+def journal_fork_before():
+    """ Helper method to hold the journal locks while forking, so the child
+        doesn't inherit them taken by a thread it doesn't have """
+    JOURNAL_FLUSH_LOCK.acquire()
+    JOURNAL_LOCK.acquire()
+
+def journal_fork_after():
+    """ Helper method to release the journal locks after forking """
+    JOURNAL_LOCK.release()
+    JOURNAL_FLUSH_LOCK.release()
+
+def journal_fork_child():
+    """ Helper method to start a journal in a forked child process. The
+        entries in the journal and the lock and journal file belong to the
+        parent. """
+    journal_fork_after()
+    JOURNAL_UPDATES.clear()
+    JOURNAL_APPENDS.clear()
+    if JOURNAL_FILE[0] is not None:
+        JOURNAL_FILE[0].close() # flushed by journal_log
+        os.close(JOURNAL_LOCK_FD[0]) # the parent still holds the lock
+        JOURNAL_FILE[0] = JOURNAL_LOCK_FD[0] = None
+        journal_open()
+    threading.Thread(target=journal_thread, daemon=True).start()
+
+def journal_thread():
+    """ Helper method to flush the journal periodically, and to replay the
+        journals of processes that ended """
+    replayed = time.time()
+    while True:
+        JOURNAL_EVENT.wait(WRITE_BEHIND / 1000)
+        JOURNAL_EVENT.clear()
+        try:
+            journal_flush()
+            if JOURNAL_FILE[0] is not None and \
+                    time.time() - replayed > JOURNAL_REPLAY_INTERVAL:
+                replayed = time.time()
+                journal_replay()
+        except Exception:
+            traceback.print_exc()
+
+
+# Read-through cache
+#--------------------
+# Kinds opt in with enable_cache(). Entries are kept as JSON text, so every
+# hit returns a fresh copy that the caller is free to modify. Writes bump a
+# generation counter, so a read that raced with a write never caches the
+# value it read.
+
+CACHE_MAXSIZE = 256
+CACHE_TTL = int(os.getenv("BUNQ2IFTTT_CACHE_TTL", "60"))
+CACHE_KINDS = set()
+CACHE = collections.OrderedDict()
+CACHE_GENERATION = [0]
+CACHE_STATS = {}
+CACHE_LOCK = threading.Lock()
+
+def enable_cache(kind):
+    """ Cache records of the given kind in memory """
+    CACHE_KINDS.add(kind)
+
+def cache_get(kind, index):
+    """ Look up a record in the cache, returns a (hit, data) tuple """
+    with CACHE_LOCK:
+        stats = CACHE_STATS.setdefault(kind, {"hits": 0, "misses": 0})
+        entry = CACHE.get((kind, index))
+        if entry is None or entry[0] < time.time():
+            stats["misses"] += 1
+            return False, None
+        CACHE.move_to_end((kind, index))
+        stats["hits"] += 1
+        text = entry[1]
+    return True, json.loads(text)
+
+def cache_put(kind, index, data, generation):
+    """ Add a record to the cache, unless it was written after generation """
+    text = json.dumps(data)
+    with CACHE_LOCK:
+        if generation != CACHE_GENERATION[0]:
+            return
+        CACHE[(kind, index)] = (time.time() + CACHE_TTL, text)
+        CACHE.move_to_end((kind, index))
+        while len(CACHE) > CACHE_MAXSIZE:
+            CACHE.popitem(last=False)
+
+def cache_invalidate(kind, index):
+    """ Remove a record from the cache after it has been written """
+    if kind not in CACHE_KINDS:
+        return
+    with CACHE_LOCK:
+        CACHE_GENERATION[0] += 1
+        CACHE.pop((kind, str(index)), None)
+
+def cache_stats():
+    """ Return the cache hit/miss counters per kind """
+    with CACHE_LOCK:
+        return {kind: dict(stats) for kind, stats in CACHE_STATS.items()}
+
+
+# SQLite storage
+#----------------
+# All records are stored as JSON in a single (kind, id, data) table. Labels
+# used in queries get an index on the JSON-extracted value, created on the
+# first query using that label. Seen objects have a separate table, so
+# seen() is a single atomic insert.
+
+SQLITE = threading.local()
+SQLITE_INDEXES = set()
+
+def sqlite_connection():
+    """ Return the SQLite connection of the current thread """
+    conn = getattr(SQLITE, "conn", None)
+    if conn is None:
+        dirname = os.path.dirname(SQLITE_PATH)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        conn = sqlite3.connect(SQLITE_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS records ("
+                     "kind TEXT NOT NULL, id TEXT NOT NULL, "
+                     "data TEXT NOT NULL, PRIMARY KEY (kind, id)) "
+                     "WITHOUT ROWID")
+        conn.execute("CREATE TABLE IF NOT EXISTS seen ("
+                     "kind TEXT NOT NULL, id TEXT NOT NULL, "
+                     "timestamp INTEGER NOT NULL, PRIMARY KEY (kind, id)) "
+                     "WITHOUT ROWID")
+        conn.execute("CREATE INDEX IF NOT EXISTS seen_timestamp "
+                     "ON seen (kind, timestamp)")
+        SQLITE.conn = conn
+    return conn
+
+@contextlib.contextmanager
+def sqlite_transaction():
+    """ Run the enclosed statements in a single SQLite write transaction """
+    conn = sqlite_connection()
+    if conn.in_transaction:
+        yield conn # part of an enclosing transaction
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def sqlite_label(label):
+    """ Return the SQL expression for a label, making sure it is indexed """
+    if not re.fullmatch(r"\w+", label):
+        raise ValueError("Invalid label: "+label)
+    expr = "json_extract(data, '$.{}')".format(label)
+    if label not in SQLITE_INDEXES:
+        sqlite_connection().execute(
+            "CREATE INDEX IF NOT EXISTS records_{} ON records (kind, {})"
+            .format(label, expr))
+        SQLITE_INDEXES.add(label)
+    return expr
+
+def sqlite_projection(labels):
+    """ Return the SQL expression for a JSON array with two arrays: the
+        values of the given labels of a record, and their JSON types, which
+        are null for missing labels (and "null" for null values) """
+    for label in labels:
+        if not re.fullmatch(r"\w+", label):
+            raise ValueError("Invalid label: "+label)
+    # with a single path json_extract doesn't return JSON
+    paths = list(labels) * 2 if len(labels) == 1 else labels
+    return "json_array(json_extract(data, {}), json_array({}))".format(
+        ", ".join("'$.{}'".format(label) for label in paths),
+        ", ".join("json_type(data, '$.{}')".format(label)
+                  for label in labels))
+
+
+
+# Shards of the local storage
+#-----------------------------
+# A local record is stored as db/<kind>/<shard>/<index>, where the shard is
+# the first two hex digits of the SHA-1 of the index, so no directory gets
+# more than 1/256 of the records of a kind. Kinds with a SHARD_MARKER file
+# use this layout. Records stored before directly in db/<kind>/ are moved
+# into their shards on the first access to the kind in a process; the old
+# directory is first renamed to db/<kind>.unsharded, so an interrupted move
+# is completed on the next start. Processes move the records one at a time,
+# holding the flock on db/.lock/migrate.
+#
+# Records are written to a temporary file in db/<kind>/.tmp/ and renamed
+# over the old file, so readers never see a partially written record and
+# don't need a lock. With BUNQ2IFTTT_FSYNC=1 the file and the rename are
+# flushed to disk before the write returns.
+
+SHARDS = frozenset("{:02x}".format(shard) for shard in range(256))
+SHARD_MARKER = ".sharded"
+SHARD_TMP = ".tmp"
+LOCAL_FSYNC = os.getenv("BUNQ2IFTTT_FSYNC") == "1"
+LOCAL_SHARDED = set()
+LOCAL_SHARD_LOCK = threading.Lock()
+
+def local_dir(kind):
+    """ Helper method to return the directory of a kind in local storage """
+    return "db" + os.sep + str(kind)
+
+def local_shard(index):
+    """ Helper method to return the shard of a local record """
+    return hashlib.sha1(str(index).encode("utf-8")).hexdigest()[:2]
+
+def local_path(kind, index):
+    """ Helper method to return the file name of a local record """
+    local_migrate(kind)
+    return local_dir(kind) + os.sep + local_shard(index) + os.sep + str(index)
+
+def local_makedirs(kind, dirname):
+    """ Helper method to create the directory of a shard, marking the
+        directory of a new kind as sharded """
+    base = local_dir(kind)
+    if not os.path.isdir(base):
+        os.makedirs(base, exist_ok=True)
+        with open(base + os.sep + SHARD_MARKER, "w"):
             pass
+    os.makedirs(dirname, exist_ok=True)
+
+def local_names(kind, after=None):
+    """ Helper method to iterate over the names of the local records of a
+        kind, shard by shard, optionally starting after a given name. Only
+        one shard is listed at a time. """
+    local_migrate(kind)
+    base = local_dir(kind)
+    try:
+        shards = sorted(SHARDS.intersection(os.listdir(base)))
+    except FileNotFoundError:
+        return
+    first = None if after is None else local_shard(after)
+    for shard in shards:
+        if first is not None and shard < first:
+            continue
+        try:
+            names = sorted(os.listdir(base + os.sep + shard))
+        except FileNotFoundError:
+            continue
+        if shard == first:
+            names = names[bisect.bisect_right(names, after):]
+        yield from names
+
+def local_migrate(kind):
+    """ Helper method to move the records of a kind stored before sharding
+        into their shards, checked once per process """
+    kind = str(kind)
+    if kind in LOCAL_SHARDED:
+        return
+    with LOCAL_SHARD_LOCK, local_flock("migrate"):
+        if kind in LOCAL_SHARDED:
+            return
+        base = local_dir(kind)
+        old = base + ".unsharded"
+        if os.path.isdir(base) and \
+                not os.path.isfile(base + os.sep + SHARD_MARKER):
+            os.rename(base, old)
+        if os.path.isdir(old):
+            names = os.listdir(old)
+            print("[storage] Moving {} {} records into shards".format(
+                len(names), kind))
+            local_makedirs(kind, base)
+            for name in names:
+                dirname = base + os.sep + local_shard(name)
+                os.makedirs(dirname, exist_ok=True)
+                os.replace(old + os.sep + name, dirname + os.sep + name)
+            os.rmdir(old)
+        LOCAL_SHARDED.add(kind)
+
+
+# Memory storage
+#----------------
+# Records are kept as JSON text in a dict per kind, so every read returns a
+# fresh copy, and seen objects as their timestamp. One lock protects both.
+# With BUNQ2IFTTT_MEMORY_SNAPSHOT set, everything is loaded from that file
+# at start, and written to it (atomically) by a background thread when
+# something changed, and at exit. Writes since the last snapshot are lost
+# when the process is killed. The memory storage is for a single process
+# only: processes forked after the import (e.g. gunicorn workers) each get
+# a copy that diverges from the others, and they overwrite each other's
+# snapshots.
+
+MEMORY = {}
+MEMORY_SEEN = {}
+MEMORY_DIRTY = [False]
+MEMORY_LOCK = threading.Lock()
+MEMORY_SNAPSHOT = os.getenv("BUNQ2IFTTT_MEMORY_SNAPSHOT")
+MEMORY_SNAPSHOT_INTERVAL = int(os.getenv(
+    "BUNQ2IFTTT_MEMORY_SNAPSHOT_INTERVAL", "60"))
+
+def memory_query(kind, label, comparator, value, page_size, cursor):
+    """ Helper method for query_page, used with the memory storage """
+    with MEMORY_LOCK:
+        records = MEMORY.get(kind, {})
+        names = sorted(records)
+        start = 0 if cursor is None else bisect.bisect_right(names, cursor)
+        result = []
+        cursor = None
+        for name in names[start:]:
+            data = json.loads(records[name])
+            if label is not None and not (
+                    label in data and
+                    COMPARATORS[comparator](data[label], value)):
+                continue
+            pop_version(data)
+            data['id'] = name
+            result.append(data)
+            if len(result) == page_size:
+                cursor = name
+                break
+    return result, cursor
+
+def commit_memory(writes, expected):
+    """ Helper method for commit, used with the memory storage """
+    with MEMORY_LOCK:
+        for (kind, index), version in expected.items():
+            text = MEMORY.get(kind, {}).get(index)
+            if text is None:
+                if version is not None:
+                    return False
+            elif json.loads(text).get("_version", 0) != version:
+                return False
+        for (kind, index), (data, large) in writes.items():
+            if data is None:
+                MEMORY.get(kind, {}).pop(index, None)
+            else:
+                MEMORY.setdefault(kind, {})[index] = json.dumps(data)
+        MEMORY_DIRTY[0] = True
+    return True
+
+def memory_snapshot():
+    """ Write the memory storage to the snapshot file, if it changed """
+    if not MEMORY_SNAPSHOT:
+        return
+    with MEMORY_LOCK:
+        if not MEMORY_DIRTY[0]:
+            return
+        text = json.dumps({"records": MEMORY, "seen": MEMORY_SEEN})
+        MEMORY_DIRTY[0] = False
+    dirname = os.path.dirname(os.path.abspath(MEMORY_SNAPSHOT))
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, "w") as fil:
+            fil.write(text)
+            fil.flush()
+            os.fsync(fil.fileno())
+        os.replace(tmpname, MEMORY_SNAPSHOT)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmpname)
+        MEMORY_DIRTY[0] = True
+        raise
+
+def memory_start():
+    """ Load the memory storage from the snapshot file, and start writing
+        snapshots periodically and at exit, also in a forked child
+        process """
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(before=MEMORY_LOCK.acquire,
+                            after_in_parent=MEMORY_LOCK.release,
+                            after_in_child=memory_fork_child)
+    if not MEMORY_SNAPSHOT:
+        return
+    if os.path.isfile(MEMORY_SNAPSHOT):
+        with open(MEMORY_SNAPSHOT) as fil:
+            data = json.loads(fil.read())
+        MEMORY.update(data["records"])
+        MEMORY_SEEN.update(data["seen"])
+    threading.Thread(target=memory_thread, daemon=True).start()
+    atexit.register(memory_snapshot)
+
+def memory_fork_child():
+    """ Helper method to release the lock held while forking, and to start
+        writing snapshots in the child process """
+    MEMORY_LOCK.release()
+    if MEMORY_SNAPSHOT:
+        threading.Thread(target=memory_thread, daemon=True).start()
+
+def memory_thread():
+    """ Helper method to write snapshots periodically """
+    while True:
+        time.sleep(MEMORY_SNAPSHOT_INTERVAL)
+        try:
+            memory_snapshot()
+        except Exception:
+            traceback.print_exc()
+
+
+# Secondary indexes for the local storage
+#-----------------------------------------
+# An index on (kind, label) is a directory tree db/_index/<kind>/<label>/
+# with one subdirectory per value, containing an empty marker file for each
+# record having that value. Indexes are built on the first equality query
+# and maintained by store_local and remove from then on.
+
+INDEX_COMPLETE = ".complete"
+
+def index_dir(kind, label=None, value=None):
+    """ Return the directory of an index, or of one value in the index """
+    fname = "db" + os.sep + "_index" + os.sep + str(kind)
+    if label is not None:
+        fname += os.sep + str(label)
+    if value is not None:
+        valuehash = hashlib.sha1(json.dumps(value, sort_keys=True)
+                                 .encode("utf-8")).hexdigest()
+        fname += os.sep + valuehash
+    return fname
+
+def index_labels(kind):
+    """ Return the labels of the given kind that have an index """
+    try:
+        return os.listdir(index_dir(kind))
+    except FileNotFoundError:
+        return []
+
+def index_changes(kind, olddata, newdata):
+    """ Helper method to return the indexed labels of a kind whose value
+        changed, as (label, hadold, hasnew) tuples """
+    result = []
+    for label in index_labels(kind):
+        hadold = olddata is not None and label in olddata
+        hasnew = newdata is not None and label in newdata
+        if hadold and hasnew and olddata[label] == newdata[label]:
+            continue
+        result.append((label, hadold, hasnew))
+    return result
+
+def index_add(kind, index, olddata, newdata):
+    """ Add the index entries of the new values of a changed record """
+    index = str(index)
+    for label, _, hasnew in index_changes(kind, olddata, newdata):
+        if hasnew:
+            fname = index_dir(kind, label, newdata[label])
+            for attempt in range(2):
+                os.makedirs(fname, exist_ok=True)
+                try:
+                    with open(fname + os.sep + index, "w"):
+                        pass
+                    break
+                except FileNotFoundError:
+                    if attempt: # removed by index_discard meanwhile
+                        raise
+
+def index_discard(kind, index, olddata, newdata):
+    """ Remove the index entries of the old values of a changed (or
+        removed) record """
+    index = str(index)
+    for label, hadold, _ in index_changes(kind, olddata, newdata):
+        if hadold:
+            old = olddata[label]
+            try:
+                os.remove(index_dir(kind, label, old) + os.sep + index)
+                os.rmdir(index_dir(kind, label, old))
+            except OSError:
+                pass
+
+def index_build(kind, label):
+    """ Build the index on (kind, label) from the stored records """
+    print("[storage] Building index {} {}".format(kind, label))
+    os.makedirs(index_dir(kind, label), exist_ok=True)
+    for fname in local_names(kind):
+        data = retrieve_local(kind, fname)
+        if data is not None and label in data:
+            valuedir = index_dir(kind, label, data[label])
+            os.makedirs(valuedir, exist_ok=True)
+            with open(valuedir + os.sep + fname, "w"):
+                pass
+    with open(index_dir(kind, label) + os.sep + INDEX_COMPLETE, "w"):
+        pass
+
+def index_names(kind, label, value):
+    """ Return the names of the local records with label equal to value,
+        using the index on (kind, label). Stale entries are possible. """
+    if not os.path.isfile(index_dir(kind, label) + os.sep + INDEX_COMPLETE):
+        index_build(kind, label)
+    try:
+        return os.listdir(index_dir(kind, label, value))
+    except FileNotFoundError:
+        return []
+
+
+# Seen objects
+#--------------
+# Duplicate callbacks usually arrive within seconds, so objects passing
+# through seen() are remembered in a bounded in-process set for as long as
+# clean_seen keeps them in the storage. Only objects not in that set need
+# a storage transaction.
+#
+# On Google datastore and local storage seen objects are grouped in time
+# buckets of SEEN_BUCKET seconds, and clean_seen drops whole expired buckets
+# (a directory per bucket locally, a batched delete on Google datastore)
+# instead of checking the timestamp of every seen object. Locally a lookup
+# checks the buckets of the last SEEN_TTL seconds. On Google datastore the
+# bucket is only a property: the object is inserted under its own key, so
+# one commit both checks and stores it. Objects are then seen until the
+# next clean_seen after their bucket expired.
+#
+# Locally, seen() takes the flock of one of SEEN_LOCK_STRIPES stripes per
+# kind (db/.lock/seen-<kind>-<n>, see local_flock), so worker processes
+# sharing the db/ directory see an object only once as well. The object is then created with O_EXCL.
+# Without fcntl (Windows) a lock within this process is used instead.
+
+SEEN_MAXSIZE = 4096
+SEEN_TTL = 900
+SEEN_BUCKET = 300
+SEEN_LOCK_STRIPES = 16
+SEEN_RECENT = collections.OrderedDict()
+SEEN_STATS = {"hits": 0, "misses": 0}
+SEEN_LOCK = threading.Lock()
 
 # pylint: disable=bare-except
+@profiled
 def seen(kind, index):
     """ Write a 'seen' object with a transaction/locking to ensure
         an object is only seen once. Returns True if seen before,
         False if this is the first time."""
     index = str(index)
+    if seen_recent(kind, index):
+        return True
     result = False
+    stored = True
     if USE_GOOGLE_DATASTORE:
+        claim = uuid.uuid4().hex
         retries = 2
+        stored = False
         while retries > 0:
             retries -= 1
             try:
-                result = seen_google(kind, index)
+                result = seen_google(kind, index, claim, retries < 1)
+                stored = True
                 break
             except:
                 traceback.print_exc()
                 print("Retries left: ", retries)
+    elif USE_SQLITE:
+        cur = sqlite_connection().execute(
+            "INSERT OR IGNORE INTO seen (kind, id, timestamp) "
+            "VALUES (?, ?, ?)", (kind, index, int(time.time())))
+        result = (cur.rowcount == 0)
+    elif USE_MEMORY:
+        with MEMORY_LOCK:
+            seen_objects = MEMORY_SEEN.setdefault(kind, {})
+            result = index in seen_objects
+            seen_objects.setdefault(index, int(time.time()))
+            MEMORY_DIRTY[0] = True
     else:
-        LOCK.acquire()
-        fname = "db" + os.sep + str(kind) + "." + str(index)
-        if os.path.isfile(fname):
-            result = True
-        else:
-            with open(fname, "w") as fil:
-                fil.write(json.dumps({"timestamp": int(time.time())}))
-        LOCK.release()
+        result = seen_local(kind, index)
+    if stored:
+        # only remember what the storage has, a retry of a callback that
+        # failed together with the storage must reach the storage again
+        seen_remember(kind, index)
     return result
 # pylint: enable=bare-except
 
-def seen_google(kind, index):
-    """ Helper method for the seen method above, used with google datastore """
-    with DSCLIENT.transaction():
-        seenkey = DSCLIENT.key(kind, index)
-        entity = DSCLIENT.get(seenkey)
-        if entity is not None:
+def seen_recent(kind, index):
+    """ Helper method to check the in-process set of seen objects """
+    with SEEN_LOCK:
+        expires = SEEN_RECENT.get((kind, index))
+        if expires is not None and expires >= time.time():
+            SEEN_STATS["hits"] += 1
+            return True
+        SEEN_STATS["misses"] += 1
+        return False
+
+def seen_remember(kind, index):
+    """ Helper method to add an object to the in-process set of seen
+        objects """
+    with SEEN_LOCK:
+        SEEN_RECENT[(kind, index)] = time.time() + SEEN_TTL
+        SEEN_RECENT.move_to_end((kind, index))
+        while len(SEEN_RECENT) > SEEN_MAXSIZE:
+            SEEN_RECENT.popitem(last=False)
+
+def seen_stats():
+    """ Return how many seen() calls were answered without (hits) and with
+        (misses) a storage transaction """
+    with SEEN_LOCK:
+        return dict(SEEN_STATS)
+
+def seen_google(kind, index, claim, retry):
+    """ Helper method for the seen method above, used with google datastore.
+        The object is inserted with a single commit, which fails if it
+        already exists. claim identifies the seen() call, so a retry can
+        recognize an insert of an earlier attempt that did get committed. """
+    key = DSCLIENT.key(kind, index)
+    entity = datastore.Entity(key=key, exclude_from_indexes=["claim"])
+    entity["bucket"] = seen_buckets()[-1]
+    entity["claim"] = claim
+    try:
+        insert_google(entity)
+    except (gexceptions.AlreadyExists, gexceptions.InvalidArgument) as err:
+        # Firestore in Datastore mode reports ALREADY_EXISTS, the legacy
+        # Datastore INVALID_ARGUMENT
+        if isinstance(err, gexceptions.InvalidArgument) and \
+                "already exists" not in str(err):
+            raise
+        if retry:
+            found = DSCLIENT.get(key)
+            return found is None or found.get("claim") != claim
+        return True
+    return False
+
+def insert_google(entity):
+    """ Helper method to insert an entity on google datastore, failing if
+        it already exists. Client.put only does upserts, so the insert
+        mutation is added to a batch through the protobuf messages of the
+        library, which are not part of its public API: written for
+        google-cloud-datastore 2.x (see requirements.txt). """
+    dsbatch = DSCLIENT.batch()
+    dsbatch.begin()
+    mutation = datastore_pb2.Mutation()
+    mutation.insert._pb.CopyFrom(
+        datastore_helpers.entity_to_protobuf(entity)._pb)
+    dsbatch.mutations.append(mutation)
+    dsbatch.commit()
+
+def seen_local(kind, index):
+    """ Helper method for the seen method above, used with local storage """
+    base = "db" + os.sep + str(kind) + os.sep
+    buckets = seen_buckets()
+    with seen_lock(kind, index):
+        # seen object stored before the buckets were added
+        if os.path.isfile("db" + os.sep + str(kind) + "." + index):
+            return True
+        for bucket in buckets[:-1]:
+            if os.path.isfile(base + str(bucket) + os.sep + index):
+                return True
+        os.makedirs(base + str(buckets[-1]), exist_ok=True)
+        try:
+            os.close(os.open(base + str(buckets[-1]) + os.sep + index,
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
             return True
-        entity = datastore.Entity(key=seenkey)
-        entity["timestamp"] = int(time.time())
-        DSCLIENT.put(entity)
         return False
 
+@contextlib.contextmanager
+def seen_lock(kind, index):
+    """ Helper method to lock a seen object locally, across processes when
+        possible. Objects share SEEN_LOCK_STRIPES stripes per kind. """
+    if fcntl is None:
+        with LOCK:
+            yield
+        return
+    stripe = int(hashlib.sha1(index.encode("utf-8")).hexdigest(), 16) \
+        % SEEN_LOCK_STRIPES
+    with local_flock("seen-{}-{}".format(kind, stripe)):
+        yield
+
+def seen_buckets(now=None):
+    """ Helper method to return the time buckets that can contain seen
+        objects younger than SEEN_TTL, oldest first """
+    now = int(time.time()) if now is None else now
+    return list(range((now - SEEN_TTL) // SEEN_BUCKET, now // SEEN_BUCKET + 1))
+
+@profiled
 def clean_seen(kind):
     """ Clean up the seen index by removing all older than 15 minutes """
-    target = int(time.time()) - 900
+    target = int(time.time()) - SEEN_TTL
+    first = seen_buckets()[0]
     if USE_GOOGLE_DATASTORE:
+        qry = DSCLIENT.query(kind=kind)
+        qry.add_filter("bucket", "<", first)
+        qry.keys_only()
+        keys = [entity.key for entity in qry.fetch()]
+        # seen objects stored before the buckets were added
         qry = DSCLIENT.query(kind=kind)
         qry.add_filter("timestamp", "<", target)
         qry.keys_only()
-        for entity in qry.fetch():
-            DSCLIENT.delete(entity.key)
+        keys.extend(entity.key for entity in qry.fetch())
+        for start in range(0, len(keys), 500):
+            DSCLIENT.delete_multi(keys[start:start+500])
+    elif USE_SQLITE:
+        sqlite_connection().execute(
+            "DELETE FROM seen WHERE kind = ? AND timestamp < ?",
+            (kind, target))
+    elif USE_MEMORY:
+        with MEMORY_LOCK:
+            seen_objects = MEMORY_SEEN.get(kind, {})
+            for index, timestamp in list(seen_objects.items()):
+                if timestamp < target:
+                    del seen_objects[index]
+            MEMORY_DIRTY[0] = True
     else:
-        fname = "db" + os.sep + str(kind) + os.sep
+        base = "db" + os.sep + str(kind)
         try:
-            names = os.listdir(fname)
+            names = os.listdir(base)
         except FileNotFoundError:
-            return
-        for fname in names:
+            names = []
+        for name in names:
+            if name.isdigit() and int(name) < first:
+                shutil.rmtree(base + os.sep + name, ignore_errors=True)
+        # seen objects stored before the buckets were added
+        for fname in glob.glob(base + ".*"):
             with open(fname) as fil:
                 data = json.loads(fil.read())
             if data["timestamp"] < target:
                 os.remove(fname)
+
+
+if USE_MEMORY:
+    memory_start()
+if WRITE_BEHIND:
+    journal_start()
+elif not USE_GOOGLE_DATASTORE and not USE_MEMORY:
+    journal_replay()
@@ -11,6 +11,7 @@ from flask import request
 
 import bunq
 import payment
+import util
 
 
 def target_balance_internal():
@@ -131,6 +132,12 @@ def target_balance_internal():
             "message": result["Error"][0]["error_description"]
         }]}), 400
 
+    # the balances change before the callback of the payment arrives
+    if fields["payment_type"] == "DIRECT":
+        for iban in [fields["account"], fields["other_account"]]:
+            util.forget_account_balance(iban,
+                                        result["Response"][0]["Id"]["id"])
+
     return json.dumps({"data": [{
         "id": str(result["Response"][0]["Id"]["id"])}]})
 
@@ -308,8 +315,17 @@ def check_fields(internal, fields):
 
 
 def get_balance(config, account, account2=None):
-    """ Retrieve the balance of one or two accounts """
-    balances = bunq.retrieve_account_balances(config)
+    """ Retrieve the balance of one or two accounts, using the balances
+        reported by callbacks when these are recent enough """
+    balances = {}
+    for iban in [account, account2]:
+        if iban is not None:
+            balance = util.get_account_balance(iban)
+            if balance is not None:
+                balances[iban] = balance
+    if account not in balances or \
+            (account2 is not None and account2 not in balances):
+        balances = bunq.retrieve_account_balances(config)
     if account2 is None and account in balances:
         return balances[account]
     if account in balances and account2 in balances:
@@ -5,12 +5,19 @@ Mainly to handle storage and caching of some frequently used data elements
 """
 # pylint: disable=global-statement
 
+import os
+import time
+import traceback
+
 import bunq
 import storage
 
 # Use global variables as in-memory cache mechanisms
 _IFTTT_SERVICE_KEY = None
 
+# The session cookie is checked on every page request
+storage.enable_cache("config")
+
 
 # WARNING: the follow setting is extremely dangerous to change !!!!!!!!!!!!!!!!
 # WARNING: you can loose all your money !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
@@ -48,6 +55,57 @@ def save_ifttt_service_key(value):
     storage.store("bunq2IFTTT", "ifttt_service_key", {"value": value})
 
 
+# Balances reported by MUTATION callbacks are used instead of asking bunq,
+# for at most BUNQ2IFTTT_BALANCE_MAX_AGE seconds (0 to always ask bunq).
+# Callbacks can arrive out of order, so a balance is only replaced by that
+# of a newer payment. After making a payment the balance is forgotten until
+# the callback of that payment arrives. Errors are only logged, the balance
+# cache must not fail a callback or an action that made a payment.
+BALANCE_MAX_AGE = int(os.getenv("BUNQ2IFTTT_BALANCE_MAX_AGE", "60"))
+
+def get_account_balance(iban):
+    """ Return the recently reported balance of an account, or None """
+    if BALANCE_MAX_AGE <= 0:
+        return None
+    try:
+        entity = storage.retrieve("balance", iban)
+    except Exception:
+        traceback.print_exc()
+        print("[balance] ERROR retrieving the balance of " + iban)
+        return None
+    if entity is None or entity["balance"] is None or \
+            time.time() - entity["timestamp"] > BALANCE_MAX_AGE:
+        return None
+    return entity["balance"]
+
+def save_account_balance(iban, balance, payment_id):
+    """ Save the balance of an account after the given payment """
+    def change(entity):
+        if entity is not None and entity["payment_id"] >= payment_id:
+            return None # a newer payment was reported already
+        return {"balance": balance, "payment_id": payment_id,
+                "timestamp": time.time()}
+    try:
+        storage.update("balance", iban, change)
+    except Exception:
+        traceback.print_exc()
+        print("[balance] ERROR saving the balance of " + iban)
+
+def forget_account_balance(iban, payment_id):
+    """ Forget the balance of an account until the callback of the given
+        payment arrives """
+    def change(entity):
+        if entity is not None and entity["payment_id"] >= payment_id:
+            return None # the balance includes the payment already
+        return {"balance": None, "payment_id": payment_id - 1,
+                "timestamp": time.time()}
+    try:
+        storage.update("balance", iban, change)
+    except Exception:
+        traceback.print_exc()
+        print("[balance] ERROR forgetting the balance of " + iban)
+
+
 def check_valid_bunq_account(iban, permission=None, config=None):
     """ Return whether the account is valid for the given permission """
     accs = get_bunq_accounts(permission, config)
@@ -87,9 +145,12 @@ def get_bunq_accounts_with_permissions(config):
 def update_bunq_accounts():
     """ Update the list of bunq accounts """
     config = bunq.retrieve_config()
-    bunq.retrieve_accounts(config)
-    sync_permissions(config)
-    bunq.save_config(config)
+    with bunq.low_priority():
+        bunq.retrieve_accounts(config)
+    def change(tosave):
+        tosave["accounts"] = config["accounts"]
+        sync_permissions(tosave)
+    bunq.update_config(change)
 
 def sync_permissions(config):
     """ Synchronize permissions between the old and new account lists """
@@ -146,13 +207,13 @@ def account_change_permission(iban, permission, value):
         return False
     value = (value == "true")
 
-    config = bunq.retrieve_config()
-    if "permissions" not in config:
-        config["permissions"] = {}
+    def change(config):
+        if "permissions" not in config:
+            config["permissions"] = {}
 
-    if iban not in config["permissions"]:
-        config["permissions"][iban] = {}
+        if iban not in config["permissions"]:
+            config["permissions"][iban] = {}
 
-    config["permissions"][iban][permission] = value
-    bunq.save_config(config)
+        config["permissions"][iban][permission] = value
+    bunq.update_config(change)
     return True
@@ -0,0 +1,129 @@
+"""
+Benchmark of the compression of trigger histories: size and throughput of
+history slots with and without compression
+
+Fills histories of 50 items shaped like the mutation and request items of
+the bunq callbacks, with varying amounts, names and descriptions, and
+reports the mean size of a stored slot as JSON (plain, compressed without
+and with the preset dictionary), the time to compress and decompress a
+slot, and the time to insert and read back the full histories on the
+local storage for a compressed and a plain kind.
+
+Usage: python tools/bench_compression.py [histories]
+"""
+
+import base64
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "app"))
+os.environ.pop("BUNQ2IFTTT_STORAGE", None)
+os.chdir(tempfile.mkdtemp())
+
+import storage # pylint: disable=wrong-import-position
+
+HISTORY = 50
+NAMES = ["J. Jansen", "Albert Heijn 1403", "NS Groep IZ Reizigers",
+         "Belastingdienst", "Gemeente Amsterdam", "Spotify AB", "P. de Vries",
+         "Coolblue B.V.", "Vattenfall Klantenservice N.V."]
+WORDS = ["Invoice", "Rent", "October", "Groceries", "Refund", "Order",
+         "Subscription", "Dinner", "Energy", "Tikkie", "for", "the"]
+
+
+def iban(rnd):
+    """ Return a random Dutch IBAN """
+    return "NL{:02d}BUNQ{:010d}".format(rnd.randrange(100),
+                                        rnd.randrange(10**10))
+
+def item(rnd, num):
+    """ Return a history item like the bunq callbacks store """
+    stamp = 1514000000 + num * 3607 + rnd.randrange(3600)
+    created = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(stamp))
+    metaid = 10000000 + num * 13 + rnd.randrange(13)
+    result = {
+        "created_at": created,
+        "date": created[:10],
+        "amount": "{:.2f}".format(rnd.uniform(-250, 250)),
+        "account": "NL42BUNQ0123456789",
+        "account_name": "Main account",
+        "counterparty_account": iban(rnd),
+        "counterparty_name": rnd.choice(NAMES),
+        "description": " ".join(rnd.choice(WORDS)
+                                for _ in range(rnd.randrange(1, 7))),
+        "meta": {"id": metaid, "timestamp": stamp},
+    }
+    if num % 5:
+        result["type"] = rnd.choice(["PAYMENT", "BUNQME", "IDEAL", "SAVINGS"])
+        result["balance"] = "{:.2f}".format(rnd.uniform(0, 5000))
+        result["payment_id"] = metaid
+    else:
+        result["request_id"] = metaid
+    return result
+
+def size(data):
+    """ Return the size of a record as JSON """
+    return len(json.dumps(data, separators=(",", ":")))
+
+def plain_zlib(data):
+    """ Return data compressed without a preset dictionary """
+    text = json.dumps(data["value"], separators=(",", ":")).encode("utf-8")
+    return {"_zlib": base64.b64encode(
+        zlib.compress(text, storage.COMPRESS_LEVEL)).decode("ascii")}
+
+def timed(func):
+    """ Return the time func takes in milliseconds """
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+def main():
+    """ Run the benchmark and print the results """
+    histories = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rnd = random.Random(42)
+    items = [item(rnd, num) for num in range(histories * HISTORY)]
+    records = [{"value": value} for value in items]
+    compressed = [storage.compress_record(data) for data in records]
+
+    sizes = {"plain": statistics.mean(size(data) for data in records),
+             "zlib": statistics.mean(size(plain_zlib(data))
+                                     for data in records),
+             "zlib+dict": statistics.mean(size(data) for data in compressed)}
+    print("slot size: " + ", ".join(
+        "{} {:.0f} bytes".format(name, mean) for name, mean in sizes.items())
+          + " ({:.0%} of plain)".format(sizes["zlib+dict"] / sizes["plain"]))
+    print("compressed slots: {} of {}".format(
+        sum(1 for data in compressed if "value" not in data), len(records)))
+
+    compress = timed(lambda: [storage.compress_record(data)
+                              for data in records])
+    decompress = timed(lambda: [storage.decompress_record(dict(data))
+                                for data in compressed])
+    print("per slot: compress {:.1f} us, decompress {:.1f} us".format(
+        compress * 1000 / len(records), decompress * 1000 / len(records)))
+
+    storage.enable_compression("bench_zlib")
+    for kind in ["bench_plain", "bench_zlib"]:
+        insert = timed(lambda kind=kind: [
+            storage.insert_value_maxsize(kind, "t{}_t".format(num // HISTORY),
+                                         value, HISTORY)
+            for num, value in enumerate(items)])
+        read = timed(lambda kind=kind: [
+            storage.get_latest_values(kind, "t{}_t".format(num), HISTORY)
+            for num in range(histories)])
+        disk = sum(os.path.getsize(os.path.join(path, name))
+                   for path, _, names in os.walk(storage.local_dir(kind))
+                   for name in names)
+        print("{:<12} insert {:6.1f} us/item, read {:6.2f} ms/history, "
+              "{:.0f} kB on disk".format(kind, insert * 1000 / len(items),
+                                        read / histories, disk / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark of bunq API requests over the shared keep-alive session against
+a new connection per request (as requests.request does)
+
+Starts a local HTTPS server with a self-signed certificate as a stand-in
+for the bunq API, and times GET requests through bunq.send, which uses the
+shared session bunq.HTTP, and through requests.request, which makes a TCP
+connection and a TLS handshake for every request.
+
+Usage: python tools/bench_http.py [count]
+"""
+
+import datetime
+import http.server
+import os
+import ssl
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "app"))
+# bunq reads the settings at import, which aren't used here
+for _name in ["IFTTT_SERVICE_KEY", "AUTH0_DOMAIN", "AUTH0_AUDIENCE",
+              "ISSUER", "ALGORITHMS", "AUTH0_USERINFO"]:
+    os.environ.setdefault(_name, "bench")
+
+import bunq # pylint: disable=wrong-import-position
+
+BODY = b'{"Response": [{"Id": {"id": 1}}]}'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """ Answers every GET with a small JSON body, keeping the connection """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """ Send the reply """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+def certificate(dirname):
+    """ Write a self-signed certificate for localhost, returns the paths of
+        the certificate and key files """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+        .public_key(key.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost")]),
+                       critical=False) \
+        .sign(key, hashes.SHA256())
+    certfile = os.path.join(dirname, "cert.pem")
+    keyfile = os.path.join(dirname, "key.pem")
+    with open(certfile, "wb") as fil:
+        fil.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as fil:
+        fil.write(key.private_bytes(serialization.Encoding.PEM,
+                                    serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()))
+    return certfile, keyfile
+
+def serve(certfile, keyfile):
+    """ Start the HTTPS server in a background thread, returns its URL """
+    server = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "https://localhost:{}/v1/user".format(server.server_address[1])
+
+def timed(func, count):
+    """ Call func count times, returns the latencies in milliseconds """
+    result = []
+    for _ in range(count):
+        start = time.perf_counter()
+        reply = func()
+        if reply.status_code != 200:
+            raise AssertionError("unexpected status {}".format(
+                reply.status_code))
+        result.append((time.perf_counter() - start) * 1000)
+    return result
+
+def report(name, latencies):
+    """ Print the median and 95th percentile of latencies """
+    latencies = sorted(latencies)
+    print("{:<24} median {:6.2f} ms, p95 {:6.2f} ms".format(
+        name, statistics.median(latencies),
+        latencies[int(len(latencies) * 0.95) - 1]))
+
+def main():
+    """ Run the benchmark and print the timings """
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    certfile, keyfile = certificate(tempfile.mkdtemp())
+    url = serve(certfile, keyfile)
+    headers = {"Cache-Control": "no-cache", "User-Agent": bunq.NAME}
+    # requests prefers the environment over Session.verify
+    os.environ["REQUESTS_CA_BUNDLE"] = certfile
+    bunq.RATE_LIMIT = False # the stand-in has no rate limits
+    report("new connection", timed(
+        lambda: requests.request("GET", url, headers=headers,
+                                 timeout=bunq.TIMEOUT),
+        count))
+    report("bunq.send (shared)", timed(
+        lambda: bunq.send("GET", url, headers, None), count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark of equality queries on the local storage: a scan of all records
+of a kind against the secondary index on the queried label
+
+Stores 100, 1k and 10k triggers in a temporary directory, 10% of them on
+"ANY" and each with a history, like the trigger kinds of the callbacks,
+and times the query for "ANY" both ways.
+
+Usage: python tools/bench_index.py [repeat]
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "app"))
+os.environ.pop("BUNQ2IFTTT_STORAGE", None)
+os.chdir(tempfile.mkdtemp())
+
+import storage # pylint: disable=wrong-import-position
+
+SIZES = [100, 1000, 10000]
+
+
+def scan(kind, label, value):
+    """ Query by reading and filtering every record, as before the index """
+    names = list(storage.local_names(kind))
+    return [data for data in storage.retrieve_many_local(kind, names)
+            if data is not None and data.get(label) == value]
+
+def indexed(kind, label, value):
+    """ Query through the index """
+    return storage.query(kind, label, "=", value)
+
+def fill(kind, size):
+    """ Store size triggers with a history each """
+    for num in range(size):
+        ident = "{}{:05d}".format(kind, num)
+        account = "ANY" if num % 10 == 0 else "NL{:02d}BUNQ{:010d}".format(
+            num % 97, num)
+        storage.store(kind, ident, {"identity": ident, "account": account,
+                                    "fields": {}, "last": False})
+        storage.insert_value_maxsize(kind, ident + "_t", {"n": num}, 50)
+
+def main():
+    """ Run the benchmark and print the timings """
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for size in SIZES:
+        kind = "bench{}".format(size)
+        fill(kind, size)
+        # build the index and warm the file system cache
+        assert len(indexed(kind, "account", "ANY")) == \
+            len(scan(kind, "account", "ANY")) == size // 10
+        times = {}
+        for name, func in [("scan", scan), ("index", indexed)]:
+            times[name] = min(timeit.repeat(
+                lambda func=func: func(kind, "account", "ANY"),
+                number=1, repeat=repeat)) * 1000
+        print("{:>6} triggers: scan {:8.2f} ms, index {:7.2f} ms".format(
+            size, times["scan"], times["index"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark of seen() on Google datastore, against the Datastore emulator
+
+Times seen() for new objects (first sighting) and for objects seen before
+(the in-process set is cleared, so every call reaches the datastore), and
+compares it with the transaction of a lookup and a put that seen() used
+before it inserted objects with a single commit.
+
+Start the emulator first, e.g.:
+    gcloud beta emulators datastore start --no-store-on-disk
+    $(gcloud beta emulators datastore env-init)
+
+Usage: python tools/bench_seen_datastore.py [count]
+"""
+
+import os
+import statistics
+import sys
+import time
+import uuid
+
+if os.getenv("DATASTORE_EMULATOR_HOST") is None:
+    sys.exit("DATASTORE_EMULATOR_HOST is not set, start the emulator first")
+os.environ.setdefault("DATASTORE_PROJECT_ID", "bunq2ifttt-bench")
+os.environ.setdefault("GAE_INSTANCE", "bench") # selects Google datastore
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "app"))
+
+import storage # pylint: disable=wrong-import-position
+
+KIND = "bench_seen"
+
+
+def seen_transaction(kind, index):
+    """ seen() on Google datastore before: a lookup and a put in one
+        transaction """
+    with storage.DSCLIENT.transaction():
+        key = storage.DSCLIENT.key(kind, index)
+        if storage.DSCLIENT.get(key) is not None:
+            return True
+        entity = storage.datastore.Entity(key=key)
+        entity["timestamp"] = int(time.time())
+        storage.DSCLIENT.put(entity)
+        return False
+
+def seen_insert(kind, index):
+    """ seen() now, without the in-process set """
+    storage.SEEN_RECENT.clear()
+    return storage.seen(kind, index)
+
+def timed(func, kind, indexes, expected):
+    """ Call func for every index, returns the latencies in milliseconds """
+    result = []
+    for index in indexes:
+        start = time.perf_counter()
+        if func(kind, index) != expected:
+            raise AssertionError("unexpected result for " + index)
+        result.append((time.perf_counter() - start) * 1000)
+    return result
+
+def report(name, latencies):
+    """ Print the median and 95th percentile of latencies """
+    latencies = sorted(latencies)
+    print("{:<24} median {:6.2f} ms, p95 {:6.2f} ms".format(
+        name, statistics.median(latencies),
+        latencies[int(len(latencies) * 0.95) - 1]))
+
+def main():
+    """ Run the benchmark and print the timings """
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for name, func in [("transaction", seen_transaction),
+                       ("insert", seen_insert)]:
+        kind = "{}_{}".format(KIND, name)
+        indexes = [uuid.uuid4().hex for _ in range(count)]
+        report(name + " first", timed(func, kind, indexes, False))
+        report(name + " repeated", timed(func, kind, indexes, True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Concurrency stress test for the versioned writes in storage
+
+Hammers the same records from many threads in several processes:
+- counter: every worker increments one record with storage.update, no
+  increment may get lost
+- flip: in every round all workers try to flip the 'last' state of the
+  same balance triggers with storage.update_many, each trigger must be
+  flipped by exactly one worker
+
+Runs against the backend selected with BUNQ2IFTTT_STORAGE (local storage
+by default) in a temporary directory. The memory storage is not shared
+between processes, so it is tested with threads only.
+
+Usage: python tools/stress_versions.py [processes] [threads] [rounds]
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "app"))
+
+TRIGGERS = ["trigger{}".format(num) for num in range(5)]
+
+
+def worker(threads, rounds, barrier, results):
+    """ Run the threads of one process, put the number of won flips """
+    import storage
+    won = [0]
+    lock = threading.Lock()
+    def run():
+        for round_ in range(rounds):
+            def change(_, trigger):
+                if trigger["last"] == round_ + 1:
+                    return None
+                trigger["last"] = round_ + 1
+                return trigger
+            barrier.wait()
+            changed = storage.update_many("trigger_balance", TRIGGERS, change)
+            storage.update("stress", "counter",
+                           lambda data: {"count": data["count"] + 1})
+            with lock:
+                won[0] += len(changed)
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put(won[0])
+
+def main():
+    """ Run the stress test and check the results """
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    if os.getenv("BUNQ2IFTTT_STORAGE") == "memory":
+        threads, processes = threads * processes, 1
+    os.chdir(tempfile.mkdtemp())
+    import storage
+    for trigger in TRIGGERS:
+        storage.store("trigger_balance", trigger, {"last": 0})
+    storage.store("stress", "counter", {"count": 0})
+
+    barrier = multiprocessing.Barrier(processes * threads)
+    results = multiprocessing.Queue()
+    if processes == 1:
+        worker(threads, rounds, barrier, results)
+    else:
+        pool = [multiprocessing.Process(target=worker,
+                                        args=(threads, rounds, barrier,
+                                              results))
+                for _ in range(processes)]
+        for proc in pool:
+            proc.start()
+        for proc in pool:
+            proc.join()
+    won = sum(results.get() for _ in range(processes))
+
+    count = storage.retrieve("stress", "counter")["count"]
+    print("counter: {} (expected {})".format(
+        count, processes * threads * rounds))
+    print("flips: {} (expected {})".format(won, len(TRIGGERS) * rounds))
+    if count != processes * threads * rounds or \
+            won != len(TRIGGERS) * rounds:
+        print("FAILED")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()